@@ -3,11 +3,36 @@ import sqlite3
 import json
 import secrets
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.request import pathname2url
 import base64
+import hashlib
+import math
+import threading
+import queue
+import atexit
+import inspect
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta
 from flask import Flask, request
 from twilio.twiml.messaging_response import MessagingResponse
 import re
+import unicodedata
+
+# Optional C-backed multi-keyword matcher; the regex matcher is used without it
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
@@ -22,119 +47,435 @@ GEMINI_API_URL = (
     "gemini-2.5-flash:generateContent?key=" + GEMINI_API_KEY
 )
 
+# One keep-alive session for all Gemini calls so each webhook reuses an open
+# TLS connection instead of handshaking again
+GEMINI_TIMEOUT = (5, 60)  # (connect, read) seconds
+GEMINI_POOL_SIZE = int(os.environ.get("GEMINI_POOL_SIZE", "32"))
+GEMINI_SESSION = requests.Session()
+# Transient overload/5xx answers are retried on the same pooled connection;
+# POST has to be allowed explicitly since urllib3 only retries idempotent verbs.
+# Read timeouts are not retried (three 60s reads would outlive gunicorn's 90s
+# worker timeout) and a 429's Retry-After is not slept on the request thread.
+GEMINI_RETRY = Retry(total=2, read=0, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504),
+                     allowed_methods=frozenset({"POST"}), respect_retry_after_header=False,
+                     raise_on_status=False)
+GEMINI_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE,
+                                             max_retries=GEMINI_RETRY))
+GEMINI_SESSION.headers.update({"Content-Type": "application/json"})
+# Output caps per task: a full 1600-character reply plus its actions is well
+# under 1k tokens, a full memo about 2k
+GEMINI_REPLY_MAX_TOKENS = int(os.environ.get("GEMINI_REPLY_MAX_TOKENS", "1024"))
+GEMINI_MEMO_MAX_TOKENS = int(os.environ.get("GEMINI_MEMO_MAX_TOKENS", "3072"))
+# gemini-2.5-flash counts thinking against maxOutputTokens, so thinking gets
+# its own budget on top of each cap instead of eating into the JSON
+GEMINI_THINKING_BUDGET = int(os.environ.get("GEMINI_THINKING_BUDGET", "1024"))
+
 # Chat history configuration
 MAX_CHAT_HISTORY = int(os.environ.get("MAX_CHAT_HISTORY", "50"))
+# Messages a user sends within this many seconds of each other are answered
+# with one Gemini call (0 disables batching)
+MESSAGE_BATCH_WINDOW = float(os.environ.get("MESSAGE_BATCH_WINDOW", "0.3"))
+# Old chat rows are trimmed once every this many inserts, not on every insert
+CHAT_HISTORY_TRIM_INTERVAL = max(1, int(os.environ.get("CHAT_HISTORY_TRIM_INTERVAL", "10")))
+# Twilio rejects WhatsApp message bodies longer than this
+MAX_MESSAGE_LENGTH = 1600
+
+# Conversation memo configuration: every MEMO_UPDATE_INTERVAL chat messages
+# are folded into a compact per-user memo, and prompts carry only the memo
+# entries relevant to the new message plus the last few raw messages
+MEMO_UPDATE_INTERVAL = int(os.environ.get("MEMO_UPDATE_INTERVAL", "10"))
+MEMO_MAX_ENTRIES = int(os.environ.get("MEMO_MAX_ENTRIES", "30"))
+MEMO_RETRIEVAL_K = 3
+MEMO_RECENT_MESSAGES = 4
+
+# Threads that build the dynamic prompt context while the request thread
+# reads chat history (0 builds it inline)
+CONTEXT_WORKERS = int(os.environ.get("CONTEXT_WORKERS", "4"))
+
+# Response cache configuration (0 disables the cache)
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "4096"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))  # seconds
+# Reuse a reply for a reworded message in the same conversation state when
+# both have exactly the same content words ("0" turns this off). Any partial
+# overlap is a miss: "expense" vs "income" is one word but another answer.
+MATCH_REWORDED_MESSAGES = os.environ.get("MATCH_REWORDED_MESSAGES", "1") != "0"
+SIMILAR_RESPONSES_PER_STATE = 16
+
+# Per-user database connections each thread keeps open, in each of its
+# read-write and read-only pools. A WAL connection holds about two file
+# descriptors, so a worker can reach threads * 2 * DB_POOL_SIZE * 2 of them:
+# with 16 gunicorn threads plus the background ones, 8 stays under the common
+# 1024 descriptor limit.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
 
 # Database directories
+USERS_DB_PATH = "users.db"
 USER_DBS_DIR = "user_dbs"
 os.makedirs(USER_DBS_DIR, exist_ok=True)
 
+# How long an accepted user's row stays cached in memory (seconds)
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "300"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "100000"))
+
+# Date handling
+DATE_FORMAT = "%Y-%m-%d"
+ONE_DAY = timedelta(days=1)
+
 # Debug/Logging configuration
-ENABLE_DETAILED_LOGGING = True  # Set to False to disable terminal output
+# Set ENABLE_DETAILED_LOGGING=false to disable terminal output
+ENABLE_DETAILED_LOGGING = os.environ.get("ENABLE_DETAILED_LOGGING", "true").lower() not in ("0", "false", "no")
+
+# Background writer configuration
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "100"))
+WRITE_BATCH_WAIT = float(os.environ.get("WRITE_BATCH_WAIT", "0.05"))  # seconds
 
 # ===========================
 # LOGGING FUNCTIONS (Can be disabled)
 # ===========================
 
+# orjson is several times faster than the json module when it is installed
+if orjson is not None:
+    parse_json = orjson.loads
+    
+    def format_json(data):
+        """Serialize data as indented JSON for the logs"""
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+else:
+    parse_json = json.loads
+    
+    def format_json(data):
+        """Serialize data as indented JSON for the logs"""
+        return json.dumps(data, indent=2, ensure_ascii=False)
+
 def log_separator():
     """Print separator line"""
-    if ENABLE_DETAILED_LOGGING:
-        print("\n" + "=" * 80)
+    print("\n" + "=" * 80)
 
 def log_section(title):
     """Print section header"""
-    if ENABLE_DETAILED_LOGGING:
-        print("\n" + "=" * 80)
-        print(f"  {title}")
-        print("=" * 80)
+    print("\n" + "=" * 80)
+    print(f"  {title}")
+    print("=" * 80)
 
 def log_info(label, content, indent=0):
     """Print labeled information"""
-    if ENABLE_DETAILED_LOGGING:
-        prefix = "  " * indent
-        print(f"{prefix}[{label}]: {content}")
+    prefix = "  " * indent
+    print(f"{prefix}[{label}]: {content}")
 
 def log_json(label, data, indent=0):
     """Print JSON data in formatted way"""
-    if ENABLE_DETAILED_LOGGING:
-        prefix = "  " * indent
-        print(f"{prefix}[{label}]:")
-        print(json.dumps(data, indent=2, ensure_ascii=False))
+    prefix = "  " * indent
+    print(f"{prefix}[{label}]:")
+    print(format_json(data))
 
 def log_user_input(phone, message):
     """Log incoming user message"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section(f"📱 INCOMING MESSAGE FROM {phone}")
-        log_info("User Message", message, 1)
-        log_info("Timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 1)
+    log_section(f"📱 INCOMING MESSAGE FROM {phone}")
+    log_info("User Message", message, 1)
+    log_info("Timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 1)
+
+def format_section(title):
+    """Build a section header as a string"""
+    return "\n" + "=" * 80 + f"\n  {title}\n" + "=" * 80
 
 def log_ai_request(prompt):
-    """Log AI request"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section("🤖 AI REQUEST")
-        log_info("Input", "Text Only", 1)
-        log_info("Prompt Length", f"{len(prompt)} characters", 1)
-        print("\n--- PROMPT START ---")
-        print(prompt[:500] + "..." if len(prompt) > 500 else prompt)
-        print("--- PROMPT END ---\n")
+    """Log AI request (printed by the background writer)"""
+    preview = prompt[:500] + "..." if len(prompt) > 500 else prompt
+    log_deferred(format_section("🤖 AI REQUEST") + "\n"
+                 f"  [Input]: Text Only\n"
+                 f"  [Prompt Length]: {len(prompt)} characters\n"
+                 f"\n--- PROMPT START ---\n{preview}\n--- PROMPT END ---\n")
 
 def log_ai_response(response):
-    """Log AI raw response"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section("🧠 AI RAW RESPONSE")
-        print(response)
+    """Log AI raw response (printed by the background writer)"""
+    log_deferred(format_section("🧠 AI RAW RESPONSE") + "\n" + response)
 
 def log_parsed_actions(actions_json):
     """Log parsed AI actions"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section("⚙️ PARSED ACTIONS")
-        log_json("Actions JSON", actions_json, 1)
+    log_section("⚙️ PARSED ACTIONS")
+    log_json("Actions JSON", actions_json, 1)
 
 def log_function_execution(function_name, params, result):
-    """Log function execution"""
-    if ENABLE_DETAILED_LOGGING:
-        print(f"\n  🔧 EXECUTING: {function_name}")
-        log_json("Parameters", params, 2)
-        log_json("Result", result, 2)
+    """Log function execution (printed by the background writer)"""
+    log_deferred(f"\n  🔧 EXECUTING: {function_name}\n"
+                 f"    [Parameters]:\n{format_json(params)}\n"
+                 f"    [Result]:\n{format_json(result)}")
 
 def log_final_response(response_text):
     """Log final bot response"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section("💬 BOT RESPONSE")
-        print(response_text)
-        log_separator()
+    log_section("💬 BOT RESPONSE")
+    print(response_text)
+    log_separator()
 
 def log_error(error_message, exception=None):
     """Log errors"""
-    if ENABLE_DETAILED_LOGGING:
-        log_section("❌ ERROR")
-        log_info("Error", error_message, 1)
-        if exception:
-            log_info("Exception", str(exception), 1)
+    log_section("❌ ERROR")
+    log_info("Error", error_message, 1)
+    if exception:
+        log_info("Exception", str(exception), 1)
+
+# With logging off, every helper becomes the same no-op so callers pay for a
+# call but no flag check or string formatting inside it
+if not ENABLE_DETAILED_LOGGING:
+    def _log_noop(*args, **kwargs):
+        pass
+    
+    log_separator = _log_noop
+    log_section = _log_noop
+    log_info = _log_noop
+    log_json = _log_noop
+    log_user_input = _log_noop
+    log_ai_request = _log_noop
+    log_ai_response = _log_noop
+    log_parsed_actions = _log_noop
+    log_function_execution = _log_noop
+    log_final_response = _log_noop
+    log_error = _log_noop
 
 # ===========================
 # DATABASE FUNCTIONS
 # ===========================
 
+# Per-connection settings; synchronous=NORMAL is safe with the WAL journal set
+# up by the init functions, mmap lets reads skip a copy out of the page cache
+CONNECTION_PRAGMAS = (
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=134217728",
+    "cache_size=-8000",
+)
+
+# STRICT tables (SQLite 3.37+) reject values that don't match the column type
+TABLE_OPTIONS = " STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+
+# INSERT ... RETURNING (SQLite 3.35+) hands back the new id in the same step
+RETURNING_ID = " RETURNING id" if sqlite3.sqlite_version_info >= (3, 35, 0) else ""
+
+# Statements run on most webhooks. sqlite3 keeps prepared statements in a
+# per-connection cache keyed by SQL text, so sharing one string per statement
+# keeps every caller on the same cached entry.
+SQL_SELECT_USER = "SELECT privacy_accepted, name FROM users WHERE phone = ?"
+SQL_UPDATE_PRIVACY = "UPDATE users SET privacy_accepted = ? WHERE phone = ?"
+SQL_UPDATE_NAME = "UPDATE users SET name = ? WHERE phone = ?"
+SQL_INSERT_CHAT = "INSERT INTO chat_history (role, message) VALUES (?, ?)"
+# Ids only grow and rows are only removed here, so everything at or below
+# NEW.id - MAX_CHAT_HISTORY is older than the newest MAX_CHAT_HISTORY rows.
+# Checking every few inserts keeps the DELETE off most of them.
+SQL_TRIM_CHAT_TRIGGER = f"""CREATE TRIGGER trim_chat_history AFTER INSERT ON chat_history
+    WHEN NEW.id % {CHAT_HISTORY_TRIM_INTERVAL} = 0
+    BEGIN
+        DELETE FROM chat_history WHERE id <= NEW.id - {MAX_CHAT_HISTORY};
+    END"""
+SQL_SELECT_CHAT = """SELECT role, message FROM (
+                         SELECT id, role, message FROM chat_history ORDER BY id DESC LIMIT ?
+                     ) ORDER BY id ASC"""
+SQL_INSERT_INCOME = ("INSERT INTO income (date, amount, category, description) VALUES (?, ?, ?, ?)"
+                     + RETURNING_ID)
+SQL_INSERT_EXPENSE = ("INSERT INTO expense (date, amount, category, description) VALUES (?, ?, ?, ?)"
+                      + RETURNING_ID)
+SQL_INSERT_LOAN = ("INSERT INTO loans (date_taken, amount, source, interest_rate, emi_amount) "
+                   "VALUES (?, ?, ?, ?, ?)" + RETURNING_ID)
+# The only tables a transaction_type may name; interpolated into SQL only after this check
+TRANSACTION_TABLES = ("income", "expense")
+SQL_SELECT_LAST_N = {
+    ttype: (f"SELECT id, '{ttype}' AS type, date, amount, category, description "
+            f"FROM {ttype} ORDER BY id DESC LIMIT ?")
+    for ttype in TRANSACTION_TABLES
+}
+# Each side is limited before the merge so only 2*N rows are sorted, not
+# both whole tables; ties on id keep income first as the old Python sort did
+SQL_SELECT_LAST_N_ALL = ("SELECT * FROM (" + SQL_SELECT_LAST_N["income"] + ")"
+                         " UNION ALL SELECT * FROM (" + SQL_SELECT_LAST_N["expense"] + ")"
+                         " ORDER BY id DESC, type DESC LIMIT ?")
+# Editable columns of a transaction; like table names, interpolated only from here
+TRANSACTION_FIELDS = ("date", "amount", "category", "description")
+SQL_UPDATE_TRANSACTION = {
+    (ttype, field): f"UPDATE {ttype} SET {field} = ? WHERE id = ?"
+    for ttype in TRANSACTION_TABLES for field in TRANSACTION_FIELDS
+}
+SQL_DELETE_TRANSACTION = {ttype: f"DELETE FROM {ttype} WHERE id = ?" for ttype in TRANSACTION_TABLES}
+
+# Every optional date range shape, keyed by which ends are given
+DATE_FILTERS = {
+    (True, True): " WHERE date BETWEEN ? AND ?",
+    (True, False): " WHERE date >= ?",
+    (False, True): " WHERE date <= ?",
+    (False, False): "",
+}
+# Both tables come back from one statement; each side keeps its own LIMIT
+SQL_VIEW_TRANSACTIONS = {
+    (types, where): " UNION ALL ".join(
+        f"SELECT * FROM (SELECT '{ttype}', id, date, amount, category, description FROM {ttype}{where}"
+        f" ORDER BY date DESC, id DESC LIMIT ?)" for ttype in types
+    ) + " ORDER BY 1, 3 DESC, 2 DESC"
+    for types in (("income",), ("expense",), TRANSACTION_TABLES)
+    for where in DATE_FILTERS.values()
+}
+# Both tables in one statement, grouped by category and sorted by total
+# (ties by name, the order GROUP BY produced before)
+SQL_SUMMARY = {
+    where: (f"SELECT 'income', category, SUM(amount), COUNT(*) FROM income{where} GROUP BY category"
+            f" UNION ALL "
+            f"SELECT 'expense', category, SUM(amount), COUNT(*) FROM expense{where} GROUP BY category"
+            f" ORDER BY 1, 3 DESC, 2")
+    for where in DATE_FILTERS.values()
+}
+
+# Room for every distinct statement the helpers issue, so none get evicted
+STATEMENT_CACHE_SIZE = 256
+
+def open_db(path, read_only=False):
+    """Open a SQLite connection with the pragmas every connection needs"""
+    if read_only:
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro",
+                               uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA query_only=1")
+    else:
+        conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+# Connections stay open between requests. A sqlite3 connection must not be
+# used by two threads at once, so each thread keeps its own: one for users.db
+# and LRUs of up to DB_POOL_SIZE read-write and read-only per-user databases.
+_db_local = threading.local()
+
+# Phones whose database schema has been created by this process
+_initialized_user_dbs = set()
+_users_db_initialized = False
+
+def _user_db_pool(name="user_conns"):
+    """Get one of this thread's phone -> connection LRUs"""
+    pool = getattr(_db_local, name, None)
+    if pool is None:
+        pool = OrderedDict()
+        setattr(_db_local, name, pool)
+    return pool
+
+def _pooled_connection(pool, phone, opener):
+    """Get phone's connection from an LRU, opening it and closing the least recent if full"""
+    conn = pool.get(phone)
+    if conn is None:
+        conn = pool[phone] = opener(phone)
+        while len(pool) > DB_POOL_SIZE:
+            pool.popitem(last=False)[1].close()
+    else:
+        pool.move_to_end(phone)
+    return conn
+
+def get_users_db():
+    """Get this thread's users.db connection"""
+    conn = getattr(_db_local, "users_conn", None)
+    if conn is None:
+        conn = _db_local.users_conn = open_db(USERS_DB_PATH)
+        # WAL is persistent per file and lets name/privacy updates run
+        # alongside other threads' user lookups; re-asserting it is a no-op
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Same guarantee as user databases: the table exists before first use,
+        # even when the app is served without running init_databases()
+        global _users_db_initialized
+        if not _users_db_initialized:
+            create_users_table(conn)
+            _users_db_initialized = True
+    return conn
+
+@lru_cache(maxsize=1024)
+def user_db_path(phone):
+    """Get the path of a user's database file"""
+    return os.path.join(USER_DBS_DIR, phone + ".db")
+
+def _open_user_db(phone):
+    """Open a read-write connection to a user's database"""
+    conn = open_db(user_db_path(phone))
+    # Every table exists before any helper touches the connection
+    if phone not in _initialized_user_dbs:
+        create_user_tables(conn)
+        _initialized_user_dbs.add(phone)
+    return conn
+
+def _open_user_db_ro(phone):
+    """Open a read-only connection to a user's database"""
+    return open_db(user_db_path(phone), read_only=True)
+
+def get_user_db(phone):
+    """Get this thread's read-write connection to a user's database"""
+    return _pooled_connection(_user_db_pool(), phone, _open_user_db)
+
+def get_user_db_ro(phone):
+    """Get a connection for SELECT-only helpers.
+
+    Reads go to a separate mode=ro / query_only connection, except while this
+    thread has a write transaction open: then the read-write connection is
+    returned so the read sees the message's own uncommitted writes.
+    """
+    conn = get_user_db(phone)
+    if conn.in_transaction:
+        return conn
+    return _pooled_connection(_user_db_pool("user_ro_conns"), phone, _open_user_db_ro)
+
+@contextmanager
+def transaction(phone):
+    """Run the block as one write transaction on a user's database.
+
+    Nested uses join the outermost transaction, so the helpers below can each
+    wrap their own write and still share a single commit when the dispatcher
+    runs several actions from one message.
+    """
+    conn = get_user_db(phone)
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+@app.teardown_appcontext
+def release_dbs(exception=None):
+    """Roll back any transaction a failed request left open on this thread's connections"""
+    conns = list(_user_db_pool().values())
+    users_conn = getattr(_db_local, "users_conn", None)
+    if users_conn is not None:
+        conns.append(users_conn)
+    for conn in conns:
+        if conn.in_transaction:
+            conn.rollback()
+
+def _reset_db_pool():
+    """Forget connections inherited from the parent process"""
+    global _db_local
+    _db_local = threading.local()
+
+os.register_at_fork(after_in_child=_reset_db_pool)
+
 def init_users_db():
     """Initialize the main users database"""
-    conn = sqlite3.connect('users.db')
+    create_users_table(get_users_db())
+
+def create_users_table(conn):
+    """Create the users table if it is missing"""
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         phone TEXT PRIMARY KEY,
         name TEXT DEFAULT 'User',
         privacy_accepted TEXT DEFAULT 'no',
         unique_id TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
     conn.commit()
-    conn.close()
 
 def init_user_db(phone):
     """Initialize individual user database with income, expense, chat, and LOANS tables"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    create_user_tables(get_user_db(phone))
+
+def create_user_tables(conn):
+    """Create any missing tables and indexes on a user database connection"""
     c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
     
     # Income table
     c.execute('''CREATE TABLE IF NOT EXISTS income (
@@ -143,8 +484,8 @@ def init_user_db(phone):
         amount REAL NOT NULL,
         category TEXT,
         description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
     
     # Expense table
     c.execute('''CREATE TABLE IF NOT EXISTS expense (
@@ -153,8 +494,8 @@ def init_user_db(phone):
         amount REAL NOT NULL,
         category TEXT,
         description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
 
     # --- NEW: Loan Table ---
     c.execute('''CREATE TABLE IF NOT EXISTS loans (
@@ -165,185 +506,353 @@ def init_user_db(phone):
         interest_rate REAL,
         emi_amount REAL,
         status TEXT DEFAULT 'active',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
     
     # Chat history table
     c.execute('''CREATE TABLE IF NOT EXISTS chat_history (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         role TEXT NOT NULL,
         message TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+        timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
+    # Recreated only when MAX_CHAT_HISTORY or the trim interval changed
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trim_chat_history'")
+    row = c.fetchone()
+    if row is None or row[0] != SQL_TRIM_CHAT_TRIGGER:
+        c.execute("DROP TRIGGER IF EXISTS trim_chat_history")
+        c.execute(SQL_TRIM_CHAT_TRIGGER.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1))
+    
+    # Conversation memo (single row): JSON entries plus the last chat id folded
+    # in, and the newest chat id an update was last attempted through
+    c.execute('''CREATE TABLE IF NOT EXISTS memo (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        entries TEXT NOT NULL,
+        last_chat_id INTEGER NOT NULL,
+        attempted_chat_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''' + TABLE_OPTIONS)
+    if "attempted_chat_id" not in {col[1] for col in c.execute("PRAGMA table_info(memo)")}:
+        c.execute("ALTER TABLE memo ADD COLUMN attempted_chat_id INTEGER NOT NULL DEFAULT 0")
+    
+    # Date ranges, category grouping, recurring detection and active loans
+    c.execute("CREATE INDEX IF NOT EXISTS idx_income_date ON income(date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expense_date ON expense(date)")
+    # The summary reads only these covering indexes: grouped by category,
+    # date-filtered and summed without touching the tables
+    c.execute("DROP INDEX IF EXISTS idx_income_cat")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_income_cat_date ON income(category, date, amount)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expense_cat_date ON expense(category, date, amount)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expense_cat_desc ON expense(category, description)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_loans_status ON loans(status)")
     
     conn.commit()
-    conn.close()
-
-def check_user_exists(phone):
-    """Check if user exists in users.db"""
-    conn = sqlite3.connect('users.db')
+    # Refresh planner statistics where they are missing or stale
+    c.execute("PRAGMA optimize")
+
+def migrate_user_dbs_to_wal():
+    """Switch every existing per-user database to WAL (a no-op once done)"""
+    for filename in os.listdir(USER_DBS_DIR):
+        if filename.endswith(".db"):
+            conn = sqlite3.connect(os.path.join(USER_DBS_DIR, filename))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+
+# phone -> (expires_at, row), least recently used first. Only accepted users
+# are cached: a pending 'no' must be re-read so an acceptance made by another
+# worker is seen at once.
+_user_row_cache = OrderedDict()
+_user_row_cache_lock = threading.Lock()
+
+def get_user_row(phone):
+    """Get (privacy_accepted, name) for a user in one read, or None if unknown"""
+    with _user_row_cache_lock:
+        cached = _user_row_cache.get(phone)
+        if cached and cached[0] > time.monotonic():
+            _user_row_cache.move_to_end(phone)
+            return cached[1]
+    
+    conn = get_users_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE phone = ?", (phone,))
-    user = c.fetchone()
-    conn.close()
-    return user
+    c.execute(SQL_SELECT_USER, (phone,))
+    row = c.fetchone()
+    if row and row[0] == 'yes':
+        with _user_row_cache_lock:
+            _user_row_cache[phone] = (time.monotonic() + USER_CACHE_TTL, row)
+            _user_row_cache.move_to_end(phone)
+            while len(_user_row_cache) > USER_CACHE_SIZE:
+                _user_row_cache.popitem(last=False)
+    return row
+
+def invalidate_user_row(phone):
+    """Drop a cached user row after it changes"""
+    with _user_row_cache_lock:
+        _user_row_cache.pop(phone, None)
 
 def create_new_user(phone):
     """Create new user with unique ID"""
     unique_id = secrets.token_hex(10)
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db()
     c = conn.cursor()
     c.execute("INSERT INTO users (phone, unique_id, privacy_accepted) VALUES (?, ?, 'no')", 
               (phone, unique_id))
     conn.commit()
-    conn.close()
-    init_user_db(phone)
+    get_user_db(phone)  # first open creates the user's tables
     return unique_id
 
 def update_privacy_acceptance(phone, accepted):
     """Update privacy policy acceptance"""
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db()
     c = conn.cursor()
-    c.execute("UPDATE users SET privacy_accepted = ? WHERE phone = ?", (accepted, phone))
+    c.execute(SQL_UPDATE_PRIVACY, (accepted, phone))
     conn.commit()
-    conn.close()
+    invalidate_user_row(phone)
 
-def get_privacy_status(phone):
-    """Get privacy acceptance status"""
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT privacy_accepted FROM users WHERE phone = ?", (phone,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
+def inserted_id(cursor):
+    """Get the id of the row an SQL_INSERT_* statement just added"""
+    return cursor.fetchone()[0] if RETURNING_ID else cursor.lastrowid
 
 def add_to_chat_history(phone, role, message):
-    """Add message to chat history, maintain max MAX_CHAT_HISTORY messages"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("INSERT INTO chat_history (role, message) VALUES (?, ?)", (role, message))
-    c.execute(f"DELETE FROM chat_history WHERE id NOT IN (SELECT id FROM chat_history ORDER BY id DESC LIMIT {MAX_CHAT_HISTORY})")
-    
-    conn.commit()
-    conn.close()
+    """Queue a chat message; the background writer stores it and trims history"""
+    _write_queue.put(("chat", phone, role, message))
 
 def get_chat_history(phone, limit=None):
     """Get chat history for context"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    conn = get_user_db(phone)
     c = conn.cursor()
     
-    limit_clause = f"LIMIT {limit}" if limit else f"LIMIT {MAX_CHAT_HISTORY}"
-    c.execute(f"SELECT role, message FROM chat_history ORDER BY id DESC {limit_clause}")
-    history = c.fetchall()
-    conn.close()
-    return list(reversed(history))
+    # Walk the primary key backwards for the newest rows, return them oldest first
+    c.execute(SQL_SELECT_CHAT, (limit or MAX_CHAT_HISTORY,))
+    return c.fetchall()
 
-def get_user_name(phone):
-    """Get user's name"""
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT name FROM users WHERE phone = ?", (phone,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else "User"
+# ===========================
+# BACKGROUND WRITER
+# ===========================
+# Chat-history inserts and bulky log output are handed to a single thread so
+# the webhook can reply as soon as the AI response is formatted.
+
+def log_deferred(text):
+    """Print text from the background writer instead of the request thread"""
+    _write_queue.put(("log", text))
+
+def _apply_writes(batch):
+    """Print queued logs and store queued chat rows, one transaction per phone"""
+    logs = []
+    chat_rows = {}
+    for item in batch:
+        if item[0] == "log":
+            logs.append(item[1])
+        else:
+            _, phone, role, message = item
+            chat_rows.setdefault(phone, []).append((role, message))
+    
+    # One write to stdout for the whole batch
+    if logs:
+        print("\n".join(logs), flush=True)
+    
+    for phone, rows in chat_rows.items():
+        conn = get_user_db(phone)
+        # The trim_chat_history trigger keeps the table at MAX_CHAT_HISTORY
+        with conn:
+            conn.executemany(SQL_INSERT_CHAT, rows)
+
+def _writer_loop(write_queue):
+    """Drain the write queue in batches of up to WRITE_BATCH_SIZE items"""
+    while True:
+        batch = [write_queue.get()]
+        try:
+            while len(batch) < WRITE_BATCH_SIZE:
+                batch.append(write_queue.get(timeout=WRITE_BATCH_WAIT))
+        except queue.Empty:
+            pass
+        
+        try:
+            _apply_writes(batch)
+        except Exception as e:
+            log_error("Background write failed", e)
+        finally:
+            for _ in batch:
+                write_queue.task_done()
+
+def flush_background_writes():
+    """Block until every queued write has been applied"""
+    _write_queue.join()
+
+def start_background_writer():
+    """Start the writer thread with a fresh queue"""
+    global _write_queue
+    _write_queue = queue.Queue()
+    threading.Thread(target=_writer_loop, args=(_write_queue,),
+                     name="background-writer", daemon=True).start()
+
+start_background_writer()
+# Threads don't survive fork, so each preforked WSGI worker starts its own writer
+os.register_at_fork(after_in_child=start_background_writer)
+atexit.register(flush_background_writes)
 
 # ===========================
 # CATEGORY DETERMINATION
 # ===========================
 
+# Tuples, not lists: the matcher tables below are compiled from this once at
+# import, so the keyword table must not change at runtime
 CATEGORY_KEYWORDS = {
-    "Food & Beverage": [
+    "Food & Beverage": (
         "chai", "coffee", "tea", "food", "khana", "breakfast", "lunch", "dinner",
         "restaurant", "cafe", "pizza", "burger", "biryani", "snack", "nashta",
         "sweets", "mithai", "juice", "drink", "meal", "dine", "eat", "khaana"
-    ],
-    "Shopping": [
+    ),
+    "Shopping": (
         "shopping", "shop", "clothes", "shirt", "pant", "shoes", "dress", "mall",
         "online", "amazon", "flipkart", "myntra", "purchase", "buy", "bought",
         "kapde", "jeans", "kurti", "saree"
-    ],
-    "Entertainment": [
+    ),
+    "Entertainment": (
         "party", "movie", "film", "concert", "game", "gaming", "netflix", "prime",
         "subscription", "entertainment", "fun", "outing", "picnic", "trip",
         "vacation", "holiday", "ghoomna", "masti"
-    ],
-    "Transport": [
+    ),
+    "Transport": (
         "uber", "ola", "taxi", "cab", "auto", "rickshaw", "petrol", "diesel",
         "fuel", "bus", "train", "metro", "flight", "travel", "parking",
         "toll", "vehicle", "gaadi", "bike", "car"
-    ],
-    "Bills & Utilities": [
+    ),
+    "Bills & Utilities": (
         "electricity", "bill", "internet", "wifi", "phone", "mobile", "recharge",
         "water", "gas", "cylinder", "rent", "maintenance", "utility",
         "broadband", "postpaid", "prepaid"
-    ],
-    "Health & Fitness": [
+    ),
+    "Health & Fitness": (
         "medicine", "medical", "doctor", "hospital", "clinic", "pharmacy",
         "chemist", "health", "gym", "fitness", "yoga", "exercise", "dawai",
         "treatment", "checkup", "test", "lab"
-    ],
-    "Education": [
+    ),
+    "Education": (
         "book", "books", "course", "class", "tuition", "school", "college",
         "university", "fees", "education", "learning", "study", "coaching",
         "tutorial", "exam", "kitab", "padhai"
-    ],
-    "Groceries": [
+    ),
+    "Groceries": (
         "grocery", "groceries", "vegetables", "sabzi", "fruits", "milk",
         "ration", "kirana", "supermarket", "dmart", "bigbasket", "provisions"
-    ],
-    "Personal Care": [
+    ),
+    "Personal Care": (
         "salon", "haircut", "shaving", "parlour", "spa", "beauty", "cosmetics",
         "makeup", "grooming", "personal"
-    ],
-    "Investment": [
+    ),
+    "Investment": (
         "investment", "stock", "mutual fund", "sip", "fd", "deposit", "gold",
         "bitcoin", "crypto", "invest", "savings"
-    ],
-    "EMI & Loans": [
+    ),
+    "EMI & Loans": (
         "emi", "loan", "credit", "debt", "installment", "payment", "card"
-    ],
-    "Gifts & Donations": [
+    ),
+    "Gifts & Donations": (
         "gift", "donation", "charity", "contribute", "help", "support", "present",
         "tohfa", "daan"
-    ],
-    "Salary": [
+    ),
+    "Salary": (
         "salary", "income", "earning", "wages", "payment received", "credit",
         "tankhwah", "kamai"
-    ],
-    "Freelance": [
+    ),
+    "Freelance": (
         "freelance", "project", "client", "work", "gig", "contract"
-    ],
-    "Business": [
+    ),
+    "Business": (
         "business", "profit", "sale", "revenue", "customer", "vyapar"
-    ]
+    )
+}
+
+# Categories in declaration order; scores are kept in a list indexed the same way
+CATEGORY_NAMES = list(CATEGORY_KEYWORDS)
+INCOME_CATEGORIES = frozenset(["Salary", "Freelance", "Business", "Investment"])
+
+# A keyword can belong to more than one category (e.g. "credit")
+KEYWORD_TO_CATEGORY_IDS = {}
+for _index, _keywords in enumerate(CATEGORY_KEYWORDS.values()):
+    for _keyword in _keywords:
+        KEYWORD_TO_CATEGORY_IDS[_keyword] = KEYWORD_TO_CATEGORY_IDS.get(_keyword, ()) + (_index,)
+
+# Longest first so multi-word keywords like "mutual fund" win the alternation
+_KEYWORD_ALTERNATION = "|".join(
+    re.escape(k) for k in sorted(KEYWORD_TO_CATEGORY_IDS, key=len, reverse=True)
+)
+
+# Whole-word hits score 2, substring-only hits (e.g. "bills" -> "bill") score 1
+CATEGORY_WORD_PATTERN = re.compile(r'\b(' + _KEYWORD_ALTERNATION + r')\b')
+CATEGORY_PARTIAL_PATTERN = re.compile(r'(?=(' + _KEYWORD_ALTERNATION + r'))')
+
+# Each regex position reports only its longest keyword, so a hit also implies
+# the keywords nested inside it ("shop" in "shopping", "payment" as a whole
+# word in "payment received")
+KEYWORD_SUBSTRINGS = {
+    k: frozenset(s for s in KEYWORD_TO_CATEGORY_IDS if s in k)
+    for k in KEYWORD_TO_CATEGORY_IDS
+}
+KEYWORD_SUBWORDS = {
+    k: frozenset(s for s in KEYWORD_TO_CATEGORY_IDS
+                 if re.search(r'\b' + re.escape(s) + r'\b', k))
+    for k in KEYWORD_TO_CATEGORY_IDS
 }
 
+def _find_keywords_regex(text_lower):
+    """Return (whole-word hits, substring hits) using the compiled alternations"""
+    word_hits = set()
+    for m in CATEGORY_WORD_PATTERN.finditer(text_lower):
+        word_hits |= KEYWORD_SUBWORDS[m.group(1)]
+    partial_hits = set()
+    for m in CATEGORY_PARTIAL_PATTERN.finditer(text_lower):
+        partial_hits |= KEYWORD_SUBSTRINGS[m.group(1)]
+    return word_hits, partial_hits
+
+def _is_word_char(ch):
+    """True for characters the re module treats as word characters"""
+    return ch.isalnum() or ch == '_'
+
+def _find_keywords_automaton(text_lower):
+    """Return (whole-word hits, substring hits) from one Aho-Corasick pass"""
+    word_hits = set()
+    partial_hits = set()
+    last = len(text_lower) - 1
+    for end, keyword in KEYWORD_AUTOMATON.iter(text_lower):
+        partial_hits.add(keyword)
+        start = end - len(keyword) + 1
+        if ((start == 0 or not _is_word_char(text_lower[start - 1])) and
+                (end == last or not _is_word_char(text_lower[end + 1]))):
+            word_hits.add(keyword)
+    return word_hits, partial_hits
+
+# The automaton reports every occurrence, nested ones included, in one pass
+if ahocorasick is not None:
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for _keyword in KEYWORD_TO_CATEGORY_IDS:
+        KEYWORD_AUTOMATON.add_word(_keyword, _keyword)
+    KEYWORD_AUTOMATON.make_automaton()
+    find_category_keywords = _find_keywords_automaton
+else:
+    find_category_keywords = _find_keywords_regex
+
+# Descriptions repeat heavily ("chai", "rent", "salary"), so memoize the result
+@lru_cache(maxsize=1024)
 def determine_category_from_text(text, transaction_type="expense"):
     """Intelligently determine category based on keywords in text"""
     text_lower = text.lower()
-    category_scores = {}
-    
-    for category, keywords in CATEGORY_KEYWORDS.items():
-        score = 0
-        for keyword in keywords:
-            if keyword in text_lower:
-                if re.search(r'\b' + re.escape(keyword) + r'\b', text_lower):
-                    score += 2
-                else:
-                    score += 1
-        
-        if score > 0:
-            category_scores[category] = score
-    
-    if category_scores:
-        best_category = max(category_scores.items(), key=lambda x: x[1])[0]
+    scores = [0] * len(CATEGORY_NAMES)
+
+    word_hits, partial_hits = find_category_keywords(text_lower)
+
+    for keyword in word_hits | partial_hits:
+        score = 2 if keyword in word_hits else 1
+        for index in KEYWORD_TO_CATEGORY_IDS[keyword]:
+            scores[index] += score
+
+    # max() keeps the first maximum, so ties go to the category declared first
+    best_index = max(range(len(scores)), key=scores.__getitem__)
+    if scores[best_index]:
+        best_category = CATEGORY_NAMES[best_index]
         
         if transaction_type == "income":
-            income_categories = ["Salary", "Freelance", "Business", "Investment"]
-            if best_category in income_categories:
+            if best_category in INCOME_CATEGORIES:
                 return best_category
             else:
                 return "Other Income"
@@ -375,41 +884,56 @@ def request_data_deletion(phone):
 
 # --- NEW FEATURES START ---
 
+DESCRIPTION_SUFFIX_PATTERN = re.compile(r'\s*\d+\s*$')
+
+def normalize_description(description):
+    """Reduce a description to the key used to spot repeats of the same expense"""
+    if not description:
+        return ""
+    return DESCRIPTION_SUFFIX_PATTERN.sub('', WHITESPACE_PATTERN.sub(' ', description.strip().lower()))
+
 def predict_recurring_expenses_db(phone):
     """Analyze history to predict upcoming recurring expenses"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    conn = get_user_db_ro(phone)
     c = conn.cursor()
     
-    # Get last 60 days of expenses
-    sixty_days_ago = (datetime.now() - timedelta(days=60)).strftime("%Y-%m-%d")
-    c.execute("SELECT date, amount, category, description FROM expense WHERE date >= ? ORDER BY date ASC", (sixty_days_ago,))
-    rows = c.fetchall()
-    conn.close()
-
-    if not rows:
+    # Group the last 60 days of expenses by (category, description) in SQL.
+    # HAVING COUNT(*) >= 2 is applied below instead, so an empty result
+    # still means there were no expenses at all.
+    # The cutoff is computed by SQLite in local time, matching datetime.now()
+    c.execute("""SELECT category, description, SUM(amount), MAX(date), COUNT(*)
+                 FROM expense WHERE date >= date('now', 'localtime', '-60 days')
+                 GROUP BY category, description
+                 ORDER BY MIN(date), MIN(id)""")
+    groups = c.fetchall()
+
+    if not groups:
         return {"status": "success", "message": "Not enough data to predict expenses."}
 
-    # Simple logic: Detect descriptions/categories that appear multiple times
-    frequency = {}
-    for r in rows:
-        key = (r[2], r[3]) # Category, Description
-        if key not in frequency:
-            frequency[key] = []
-        frequency[key].append(r)
+    # Merge groups whose descriptions only differ in case, spacing or a
+    # trailing number ("Rent", "rent ", "Rent 2"); the first one seen names it
+    frequency = defaultdict(lambda: [None, 0.0, "", 0])
+    for cat, desc, total, last_date, count in groups:
+        entry = frequency[(cat, normalize_description(desc))]
+        if entry[0] is None:
+            entry[0] = desc
+        entry[1] += total
+        entry[2] = max(entry[2], last_date)
+        entry[3] += count
 
     predictions = []
+    now = datetime.now()
     
-    for (cat, desc), transactions in frequency.items():
-        if len(transactions) >= 2:
-            # Calculate average amount
-            avg_amt = sum(t[1] for t in transactions) / len(transactions)
+    # Simple logic: Detect descriptions/categories that appear multiple times
+    for (cat, _), (desc, total, last_date, count) in frequency.items():
+        if count >= 2:
+            avg_amt = total / count
             # Estimate next date (based on last transaction day)
-            last_date_obj = datetime.strptime(transactions[-1][0], "%Y-%m-%d")
+            last_date_obj = datetime.strptime(last_date, "%Y-%m-%d")
             
             # If the last transaction was last month, expect it this month
             next_due_date = last_date_obj + timedelta(days=30)
-            days_until = (next_due_date - datetime.now()).days
+            days_until = (next_due_date - now).days
             
             if days_until > -5: # Only show if it's upcoming or slightly overdue
                 predictions.append(f"• {desc} ({cat}): ~Rs{avg_amt:.0f} expected around {next_due_date.strftime('%d %b')}")
@@ -429,14 +953,9 @@ def add_income_db(phone, date, amount, category, description):
     if not category or category == "Other":
         category = determine_category_from_text(description, "income")
     
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO income (date, amount, category, description) VALUES (?, ?, ?, ?)",
-              (date, amount, category, description))
-    transaction_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction(phone) as conn:
+        c = conn.execute(SQL_INSERT_INCOME, (date, amount, category, description))
+        transaction_id = inserted_id(c)
     
     result = {
         "status": "success",
@@ -456,14 +975,9 @@ def add_expense_db(phone, date, amount, category, description):
     if not category or category == "Other":
         category = determine_category_from_text(description, "expense")
     
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO expense (date, amount, category, description) VALUES (?, ?, ?, ?)",
-              (date, amount, category, description))
-    transaction_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction(phone) as conn:
+        c = conn.execute(SQL_INSERT_EXPENSE, (date, amount, category, description))
+        transaction_id = inserted_id(c)
     
     result = {
         "status": "success",
@@ -482,14 +996,9 @@ def add_expense_db(phone, date, amount, category, description):
 
 def add_loan_db(phone, amount, source, date_taken, interest_rate, emi_amount):
     """Add a new loan to the database"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO loans (date_taken, amount, source, interest_rate, emi_amount) VALUES (?, ?, ?, ?, ?)",
-              (date_taken, amount, source, interest_rate, emi_amount))
-    loan_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction(phone) as conn:
+        c = conn.execute(SQL_INSERT_LOAN, (date_taken, amount, source, interest_rate, emi_amount))
+        loan_id = inserted_id(c)
 
     result = {
         "status": "success",
@@ -529,16 +1038,11 @@ def calculate_loan_interest(phone, amount, interest_rate, tenure_years=1):
 
 def get_active_loans_db(phone):
     """Get active loans for context"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    conn = get_user_db_ro(phone)
     c = conn.cursor()
-    # Ensure table exists before querying (Just in case, though init_user_db handles it)
-    try:
-        c.execute("SELECT amount, source, interest_rate, emi_amount FROM loans WHERE status='active'")
-        rows = c.fetchall()
-    except sqlite3.OperationalError:
-        rows = []
-    conn.close()
+    # get_user_db creates the loans table on first open, so no existence check
+    c.execute("SELECT amount, source, interest_rate, emi_amount FROM loans WHERE status='active'")
+    rows = c.fetchall()
     
     loans = []
     for r in rows:
@@ -549,14 +1053,11 @@ def get_active_loans_db(phone):
 
 def update_transaction_db(phone, transaction_type, transaction_id, field, new_value):
     """Update a transaction field"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    conn = get_user_db(phone)
     c = conn.cursor()
     
-    allowed_fields = ['date', 'amount', 'category', 'description']
-    if field not in allowed_fields:
-        conn.close()
-        result = {"status": "error", "message": f"Invalid field. Allowed: {', '.join(allowed_fields)}"}
+    if field not in TRANSACTION_FIELDS:
+        result = {"status": "error", "message": f"Invalid field. Allowed: {', '.join(TRANSACTION_FIELDS)}"}
         log_function_execution("update_transaction_db", {
             "phone": phone, "transaction_type": transaction_type, "transaction_id": transaction_id,
             "field": field, "new_value": new_value
@@ -564,8 +1065,7 @@ def update_transaction_db(phone, transaction_type, transaction_id, field, new_va
         return result
     
     table = transaction_type.lower()
-    if table not in ['income', 'expense']:
-        conn.close()
+    if table not in TRANSACTION_TABLES:
         result = {"status": "error", "message": "Invalid transaction type"}
         log_function_execution("update_transaction_db", {
             "phone": phone, "transaction_type": transaction_type, "transaction_id": transaction_id,
@@ -573,9 +1073,9 @@ def update_transaction_db(phone, transaction_type, transaction_id, field, new_va
         }, result)
         return result
     
-    c.execute(f"SELECT * FROM {table} WHERE id = ?", (transaction_id,))
-    if not c.fetchone():
-        conn.close()
+    with transaction(phone):
+        c.execute(SQL_UPDATE_TRANSACTION[table, field], (new_value, transaction_id))
+    if c.rowcount == 0:
         result = {"status": "error", "message": f"Transaction ID {transaction_id} not found"}
         log_function_execution("update_transaction_db", {
             "phone": phone, "transaction_type": transaction_type, "transaction_id": transaction_id,
@@ -583,10 +1083,6 @@ def update_transaction_db(phone, transaction_type, transaction_id, field, new_va
         }, result)
         return result
     
-    c.execute(f"UPDATE {table} SET {field} = ? WHERE id = ?", (new_value, transaction_id))
-    conn.commit()
-    conn.close()
-    
     result = {
         "status": "success",
         "message": f"Updated {field} to '{new_value}' for transaction ID {transaction_id}"
@@ -601,22 +1097,25 @@ def update_transaction_db(phone, transaction_type, transaction_id, field, new_va
 
 def delete_transaction_db(phone, transaction_type, transaction_id):
     """Delete a transaction"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    conn = get_user_db(phone)
     c = conn.cursor()
     
     table = transaction_type.lower()
-    if table not in ['income', 'expense']:
-        conn.close()
+    if table not in TRANSACTION_TABLES:
         result = {"status": "error", "message": "Invalid transaction type"}
         log_function_execution("delete_transaction_db", {
             "phone": phone, "transaction_type": transaction_type, "transaction_id": transaction_id
         }, result)
         return result
     
-    c.execute(f"DELETE FROM {table} WHERE id = ?", (transaction_id,))
-    conn.commit()
-    conn.close()
+    with transaction(phone):
+        c.execute(SQL_DELETE_TRANSACTION[table], (transaction_id,))
+    if c.rowcount == 0:
+        result = {"status": "error", "message": f"Transaction ID {transaction_id} not found"}
+        log_function_execution("delete_transaction_db", {
+            "phone": phone, "transaction_type": transaction_type, "transaction_id": transaction_id
+        }, result)
+        return result
     
     result = {
         "status": "success",
@@ -631,51 +1130,47 @@ def delete_transaction_db(phone, transaction_type, transaction_id):
 
 def update_user_name_db(phone, new_name):
     """Update user's name"""
-    conn = sqlite3.connect('users.db')
+    conn = get_users_db()
     c = conn.cursor()
-    c.execute("UPDATE users SET name = ? WHERE phone = ?", (new_name, phone))
+    c.execute(SQL_UPDATE_NAME, (new_name, phone))
     conn.commit()
-    conn.close()
+    invalidate_user_row(phone)
     
     result = {"status": "success", "message": f"Name updated to {new_name}"}
     log_function_execution("update_user_name_db", {"phone": phone, "new_name": new_name}, result)
     
     return result
 
+def date_filter(start_date, end_date):
+    """Get the WHERE clause and params for an optional date range"""
+    where = DATE_FILTERS[bool(start_date), bool(end_date)]
+    return where, tuple(d for d in (start_date, end_date) if d)
+
 def view_transactions_db(phone, transaction_type=None, start_date=None, end_date=None, limit=None):
     """View transactions with optional filters"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
+    types = (transaction_type.lower(),) if transaction_type else TRANSACTION_TABLES
+    if any(ttype not in TRANSACTION_TABLES for ttype in types):
+        result = {"status": "error", "message": "Invalid transaction type"}
+        log_function_execution("view_transactions_db", {
+            "phone": phone, "transaction_type": transaction_type,
+            "start_date": start_date, "end_date": end_date, "limit": limit
+        }, result)
+        return result
+    
+    conn = get_user_db_ro(phone)
     c = conn.cursor()
     
     results = {"income": [], "expense": []}
     
-    types = [transaction_type] if transaction_type else ['income', 'expense']
+    # LIMIT is always bound (-1 means no limit) so each table/date-filter shape
+    # maps to one statement text in the cache
+    where, params = date_filter(start_date, end_date)
+    params += (int(limit) if limit else -1,)
     
-    for ttype in types:
-        query = f"SELECT * FROM {ttype}"
-        params = []
-        
-        if start_date and end_date:
-            query += " WHERE date BETWEEN ? AND ?"
-            params = [start_date, end_date]
-        elif start_date:
-            query += " WHERE date >= ?"
-            params = [start_date]
-        elif end_date:
-            query += " WHERE date <= ?"
-            params = [end_date]
-        
-        query += " ORDER BY date DESC, id DESC"
-        
-        if limit:
-            query += f" LIMIT {limit}"
-        
-        c.execute(query, params)
-        rows = c.fetchall()
-        results[ttype] = [{"id": r[0], "date": r[1], "amount": r[2], "category": r[3], "description": r[4]} for r in rows]
+    c.execute(SQL_VIEW_TRANSACTIONS[types, where], params * len(types))
+    for r in c.fetchall():
+        results[r[0]].append({"id": r[1], "date": r[2], "amount": r[3], "category": r[4], "description": r[5]})
     
-    conn.close()
     
     log_function_execution("view_transactions_db", {
         "phone": phone, "transaction_type": transaction_type,
@@ -686,65 +1181,20 @@ def view_transactions_db(phone, transaction_type=None, start_date=None, end_date
 
 def get_summary_db(phone, start_date=None, end_date=None):
     """Get financial summary"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+    conn = get_user_db_ro(phone)
     
-    query = "SELECT SUM(amount), COUNT(*) FROM income"
-    params = []
-    if start_date and end_date:
-        query += " WHERE date BETWEEN ? AND ?"
-        params = [start_date, end_date]
-    elif start_date:
-        query += " WHERE date >= ?"
-        params = [start_date]
-    elif end_date:
-        query += " WHERE date <= ?"
-        params = [end_date]
-    
-    c.execute(query, params)
-    income_result = c.fetchone()
-    total_income = income_result[0] or 0
-    income_count = income_result[1] or 0
-    
-    query = "SELECT SUM(amount), COUNT(*) FROM expense"
-    if params:
-        if len(params) == 2:
-            query += " WHERE date BETWEEN ? AND ?"
-        elif start_date:
-            query += " WHERE date >= ?"
-        else:
-            query += " WHERE date <= ?"
-    c.execute(query, params)
-    expense_result = c.fetchone()
-    total_expense = expense_result[0] or 0
-    expense_count = expense_result[1] or 0
-    
-    query = "SELECT category, SUM(amount), COUNT(*) FROM expense"
-    if params:
-        if len(params) == 2:
-            query += " WHERE date BETWEEN ? AND ?"
-        elif start_date:
-            query += " WHERE date >= ?"
-        else:
-            query += " WHERE date <= ?"
-    query += " GROUP BY category ORDER BY SUM(amount) DESC"
-    c.execute(query, params)
-    category_expenses = {row[0]: {"amount": row[1], "count": row[2]} for row in c.fetchall()}
-    
-    query = "SELECT category, SUM(amount), COUNT(*) FROM income"
-    if params:
-        if len(params) == 2:
-            query += " WHERE date BETWEEN ? AND ?"
-        elif start_date:
-            query += " WHERE date >= ?"
-        else:
-            query += " WHERE date <= ?"
-    query += " GROUP BY category ORDER BY SUM(amount) DESC"
-    c.execute(query, params)
-    category_income = {row[0]: {"amount": row[1], "count": row[2]} for row in c.fetchall()}
+    where, params = date_filter(start_date, end_date)
     
-    conn.close()
+    categories = {"income": [], "expense": []}
+    for ttype, category, amount, count in conn.execute(SQL_SUMMARY[where], params * 2):
+        categories[ttype].append((category, amount, count))
+    
+    totals = {ttype: (sum(row[1] for row in rows), sum(row[2] for row in rows))
+              for ttype, rows in categories.items()}
+    total_income, income_count = totals["income"]
+    total_expense, expense_count = totals["expense"]
+    category_expenses = {cat: {"amount": amount, "count": count} for cat, amount, count in categories["expense"]}
+    category_income = {cat: {"amount": amount, "count": count} for cat, amount, count in categories["income"]}
     
     balance = total_income - total_expense
     result = {
@@ -777,70 +1227,45 @@ def get_financial_health_snapshot(phone):
     active_loans = get_active_loans_db(phone)
     loans_text = "\n".join(active_loans) if active_loans else "No active loans detected."
 
-    return (f"FINANCIAL SNAPSHOT (Current Month):\n"
-            f"- Total Income: Rs{summary['total_income']}\n"
-            f"- Total Expenses: Rs{summary['total_expense']}\n"
-            f"- Current Balance: Rs{summary['balance']}\n"
-            f"- Top Expense Categories: {', '.join(list(summary['category_expenses'].keys())[:3])}\n"
-            f"ACTIVE LOANS:\n{loans_text}")
+    snapshot = (f"FINANCIAL SNAPSHOT (Current Month):\n"
+                f"- Total Income: Rs{summary['total_income']}\n"
+                f"- Total Expenses: Rs{summary['total_expense']}\n"
+                f"- Current Balance: Rs{summary['balance']}\n"
+                f"- Top Expense Categories: {', '.join(list(summary['category_expenses'].keys())[:3])}\n"
+                f"ACTIVE LOANS:\n{loans_text}")
+    return snapshot
 
 def get_last_transaction_db(phone, transaction_type=None, limit=5):
     """Get last N transactions for context"""
-    db_path = os.path.join(USER_DBS_DIR, f"{phone}.db")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    results = []
-    
-    types = [transaction_type] if transaction_type else ['income', 'expense']
+    conn = get_user_db_ro(phone)
     
-    for ttype in types:
-        c.execute(f"SELECT * FROM {ttype} ORDER BY id DESC LIMIT ?", (limit,))
-        rows = c.fetchall()
-        for r in rows:
-            results.append({
-                "id": r[0],
-                "type": ttype,
-                "date": r[1],
-                "amount": r[2],
-                "category": r[3],
-                "description": r[4]
-            })
-    
-    conn.close()
+    if transaction_type is None:
+        rows = conn.execute(SQL_SELECT_LAST_N_ALL, (limit, limit, limit)).fetchall()
+    elif transaction_type.lower() in SQL_SELECT_LAST_N:
+        rows = conn.execute(SQL_SELECT_LAST_N[transaction_type.lower()], (limit,)).fetchall()
+    else:
+        rows = []
     
-    results.sort(key=lambda x: x['id'], reverse=True)
+    results = [{
+        "id": r[0],
+        "type": r[1],
+        "date": r[2],
+        "amount": r[3],
+        "category": r[4],
+        "description": r[5]
+    } for r in rows]
     
-    return results[:limit]
+    return results
 
 # ===========================
 # AI SYSTEM PROMPT
 # ===========================
 
-def get_system_prompt(current_date, yesterday, tomorrow, phone):
-    """Generate comprehensive system prompt with context"""
-    
-    recent_transactions = get_last_transaction_db(phone, limit=10)
-    transactions_context = "\n".join([
-        f"  ID {t['id']} ({t['type']}): {t['date']} - Rs{t['amount']} - {t['category']} - {t['description']}"
-        for t in recent_transactions
-    ]) if recent_transactions else "  No transactions yet"
-    
-    # NEW: Get snapshot for Planning features
-    financial_snapshot = get_financial_health_snapshot(phone)
-    
-    return """You are an intelligent WhatsApp Finance Manager Bot & Expert Financial Advisor. 
+# Kept byte-identical across users and turns so Gemini's implicit prefix
+# cache can reuse it; everything per-user goes in build_dynamic_context.
+STATIC_SYSTEM_PROMPT = """You are an intelligent WhatsApp Finance Manager Bot & Expert Financial Advisor. 
 Interpret natural language and execute database operations.
 
-CURRENT DATE: """ + current_date + """
-YESTERDAY: """ + yesterday + """
-TOMORROW: """ + tomorrow + """
-
-""" + financial_snapshot + """
-
-RECENT TRANSACTIONS:
-""" + transactions_context + """
-
 FUNCTIONS AVAILABLE:
 1. add_income_db(phone, date, amount, category, description)
 2. add_expense_db(phone, date, amount, category, description)
@@ -854,7 +1279,7 @@ FUNCTIONS AVAILABLE:
 10. add_loan_db(phone, amount, source, date_taken, interest_rate, emi_amount)
 11. calculate_loan_interest(phone, amount, interest_rate, tenure_years)
 
-DATE PARSING: today/aaj=""" + current_date + """, yesterday/kal=""" + yesterday + """, tomorrow=""" + tomorrow + """
+DATE PARSING: Resolve today/aaj, yesterday/kal and tomorrow using the dates given in the context below.
 
 RESPOND IN JSON:
 {
@@ -886,7 +1311,7 @@ RULES:
 - Generate concise descriptions
 - Execute multiple actions if needed
 - Use transaction IDs from context for edits
-- Always respond in valid JSON
+- Always respond in valid JSON only, without markdown code fences
 
 LOAN LOGIC:
 - If a user mentions taking a loan (e.g., "I took a 5 lakh loan"), you MUST collect the following before saving:
@@ -899,15 +1324,258 @@ LOAN LOGIC:
 - After saving a loan, provide advice on how to manage it based on their income.
 """
 
+# Filled in with format_map, which builds the result in one pass instead of
+# allocating an intermediate string per "+"
+DYNAMIC_CONTEXT_TEMPLATE = """
+===DYNAMIC===
+
+CURRENT DATE: {current_date}
+YESTERDAY: {yesterday}
+TOMORROW: {tomorrow}
+
+DATE PARSING: today/aaj={current_date}, yesterday/kal={yesterday}, tomorrow={tomorrow}
+
+{snapshot}
+
+RECENT TRANSACTIONS:
+{transactions}
+"""
+
+USER_INFO_TEMPLATE = """
+USER INFO:
+- Phone: {phone}
+- Name: {user_name}
+"""
+
+USER_TURN_TEMPLATE = """{memo_context}
+
+RECENT CHAT:
+{context}
+
+USER MESSAGE: {user_message}
+
+Analyze and respond in JSON format with actions and response_text."""
+
+BATCH_USER_TURN_TEMPLATE = """{memo_context}
+
+RECENT CHAT:
+{context}
+
+USER MESSAGES (sent back to back):
+{user_message}
+
+Handle each message on its own. Respond in JSON as {{"replies": [...]}} with exactly {count} objects, one per message in the same order, each with its own actions and response_text."""
+
+def build_prompt_prefix(phone, user_name):
+    """Get the instructions plus user info: the part of the prompt that never
+    changes for a user, so Gemini's implicit prompt cache can match it"""
+    return STATIC_SYSTEM_PROMPT + USER_INFO_TEMPLATE.format_map({"phone": phone, "user_name": user_name})
+
+def build_dynamic_context(current_date, yesterday, tomorrow, phone):
+    """Generate the per-user context block that follows STATIC_SYSTEM_PROMPT"""
+    
+    recent_transactions = get_last_transaction_db(phone, limit=10)
+    transactions_context = "\n".join([
+        f"  ID {t['id']} ({t['type']}): {t['date']} - Rs{t['amount']} - {t['category']} - {t['description']}"
+        for t in recent_transactions
+    ]) if recent_transactions else "  No transactions yet"
+    
+    # NEW: Get snapshot for Planning features
+    financial_snapshot = get_financial_health_snapshot(phone)
+    
+    return DYNAMIC_CONTEXT_TEMPLATE.format_map({
+        "current_date": current_date,
+        "yesterday": yesterday,
+        "tomorrow": tomorrow,
+        "snapshot": financial_snapshot,
+        "transactions": transactions_context,
+    })
+
+# ===========================
+# RESPONSE CACHE
+# ===========================
+
+# Only replies whose actions are all in this set are safe to replay
+READ_ONLY_FUNCTIONS = {
+    "view_transactions_db", "get_summary_db",
+    "predict_recurring_expenses_db", "calculate_loan_interest"
+}
+
+# Messages that look like they record or change data never use the cache
+MUTATING_MESSAGE_PATTERN = re.compile(
+    r'\b(add|added|delete|remove|update|change|edit|spent|spend|paid|pay|got|'
+    r'received|lent|borrowed|took|name)\b'
+)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Words that change the phrasing of a request but not what it asks for
+FILLER_WORDS = frozenset({
+    "a", "an", "the", "me", "my", "i", "you", "can", "could", "please", "pls", "plz",
+    "show", "give", "tell", "get", "what", "whats", "is", "are", "of", "for", "to",
+    "all", "just", "now", "hey", "hi", "bhai", "kya", "hai"
+})
+MESSAGE_WORD_PATTERN = re.compile(r'\w+')
+
+# cache key digest -> (expires_at, raw AI response), least recently used first
+_response_cache = OrderedDict()
+# state digest -> {content words: (expires_at, raw AI response)}, both least recently used first
+_similar_responses = OrderedDict()
+_response_cache_lock = threading.Lock()
+response_cache_stats = {"hits": 0, "similar_hits": 0, "misses": 0}
+
+def make_response_cache_key(phone, user_message, dynamic_context):
+    """Build a cache key, or None if the message must always reach Gemini.
+
+    The key is (exact digest, conversation-state digest, content words): the
+    exact digest matches the same message again, the state digest plus words
+    match a rewording of it ("show my summary" / "summary please").
+    """
+    if RESPONSE_CACHE_SIZE <= 0:
+        return None
+    
+    normalized = WHITESPACE_PATTERN.sub(' ', user_message.strip().lower())
+    if not normalized or MUTATING_MESSAGE_PATTERN.search(normalized):
+        return None
+    
+    # dynamic_context carries the date, balances and recent transactions, so
+    # any write or day change produces a new key. The previous reply is left
+    # out: it is always the answer to this same message on a repeat, so it
+    # would make every exact repeat miss.
+    state = hashlib.sha256()
+    for part in (phone, dynamic_context):
+        state.update(part.encode("utf-8"))
+        state.update(b"\0")
+    exact = state.copy()
+    exact.update(normalized.encode("utf-8"))
+    words = frozenset(MESSAGE_WORD_PATTERN.findall(normalized)) - FILLER_WORDS
+    return exact.hexdigest(), state.hexdigest(), words
+
+def _find_similar_response(state_key, words, now):
+    """Get the reply cached in this state for a rewording with the same content words (lock held)"""
+    entries = _similar_responses.get(state_key)
+    if not entries or not words:
+        return None
+    cached = entries.get(words)
+    if cached is None:
+        return None
+    if cached[0] <= now:
+        del entries[words]
+        return None
+    entries.move_to_end(words)
+    _similar_responses.move_to_end(state_key)
+    return cached[1]
+
+def get_cached_response(cache_key):
+    """Return the cached raw AI response for cache_key, if any"""
+    if cache_key is None:
+        return None
+    exact_key, state_key, words = cache_key
+    now = time.monotonic()
+    with _response_cache_lock:
+        cached = _response_cache.get(exact_key)
+        if cached is not None and cached[0] <= now:
+            del _response_cache[exact_key]
+            cached = None
+        if cached is not None:
+            _response_cache.move_to_end(exact_key)
+            response_cache_stats["hits"] += 1
+            return cached[1]
+        
+        similar = _find_similar_response(state_key, words, now)
+        if similar is not None:
+            response_cache_stats["similar_hits"] += 1
+            return similar
+        response_cache_stats["misses"] += 1
+        return None
+
+def has_cached_response(cache_key):
+    """Check whether cache_key has a live reply, without counting a hit or miss"""
+    if cache_key is None:
+        return False
+    exact_key, state_key, words = cache_key
+    now = time.monotonic()
+    with _response_cache_lock:
+        cached = _response_cache.get(exact_key)
+        if cached is not None and cached[0] > now:
+            return True
+        cached = _similar_responses.get(state_key, {}).get(words) if words else None
+        return cached is not None and cached[0] > now
+
+def store_cached_response(cache_key, ai_response, actions_json):
+    """Cache a raw AI response if every action it requests is read-only"""
+    if cache_key is None:
+        return
+    actions = actions_json.get("actions", [])
+    if any(action.get("function") not in READ_ONLY_FUNCTIONS for action in actions):
+        return
+    exact_key, state_key, words = cache_key
+    expires_at = time.monotonic() + RESPONSE_CACHE_TTL
+    with _response_cache_lock:
+        _response_cache[exact_key] = (expires_at, ai_response)
+        _response_cache.move_to_end(exact_key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+        
+        if words and MATCH_REWORDED_MESSAGES:
+            entries = _similar_responses.setdefault(state_key, OrderedDict())
+            entries[words] = (expires_at, ai_response)
+            entries.move_to_end(words)
+            while len(entries) > SIMILAR_RESPONSES_PER_STATE:
+                entries.popitem(last=False)
+            _similar_responses.move_to_end(state_key)
+            while len(_similar_responses) > RESPONSE_CACHE_SIZE:
+                _similar_responses.popitem(last=False)
+
 # ===========================
 # AI INTERACTION
 # ===========================
 
-def call_gemini_api(prompt):
+# sqlite3 releases the GIL while a query runs, so the snapshot/recent-transaction
+# reads on a worker overlap with the history and memo reads on the request thread
+_context_executor = None
+
+def start_context_executor():
+    """Create the context pool (again, in a forked worker: threads don't survive fork)"""
+    global _context_executor
+    _context_executor = (ThreadPoolExecutor(max_workers=CONTEXT_WORKERS, thread_name_prefix="context")
+                         if CONTEXT_WORKERS > 0 else None)
+
+start_context_executor()
+os.register_at_fork(after_in_child=start_context_executor)
+
+# prompt digest -> Future for Gemini calls currently on the wire
+_inflight_requests = {}
+_inflight_lock = threading.Lock()
+
+def call_gemini_api(prompt, max_tokens=GEMINI_REPLY_MAX_TOKENS):
+    """Call Gemini, sharing one request among callers sending the same prompt at once"""
+    key = hashlib.sha256(prompt.encode("utf-8")).digest()
+    with _inflight_lock:
+        future = _inflight_requests.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight_requests[key] = future
+    
+    # Followers (e.g. a Twilio retry of a webhook still in progress) wait for it
+    if not leader:
+        log_info("Gemini", "Joined in-flight request")
+        return future.result()
+    
+    try:
+        text = post_gemini_request(prompt, max_tokens)
+        future.set_result(text)
+        return text
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight_requests[key]
+
+def post_gemini_request(prompt, max_tokens):
     """Call Gemini API with REST endpoint (Text Only)"""
     try:
-        headers = {"Content-Type": "application/json"}
-        
         parts = [{"text": prompt}]
         
         data = {
@@ -918,24 +1586,38 @@ def call_gemini_api(prompt):
                 "temperature": 0.4,
                 "topK": 40,
                 "topP": 0.95,
-                "maxOutputTokens": 4096,
+                "maxOutputTokens": max_tokens + GEMINI_THINKING_BUDGET,
+                "thinkingConfig": {"thinkingBudget": GEMINI_THINKING_BUDGET},
+                # Every caller expects one JSON object, so have Gemini emit
+                # bare JSON instead of fenced text
+                "responseMimeType": "application/json",
             }
         }
         
         log_ai_request(prompt)
         
-        response = requests.post(GEMINI_API_URL, headers=headers, json=data, timeout=60)
+        response = GEMINI_SESSION.post(GEMINI_API_URL, json=data, timeout=GEMINI_TIMEOUT)
         response.raise_for_status()
         
-        result = response.json()
+        result = parse_json(response.content)
         
-        if 'candidates' in result and len(result['candidates']) > 0:
-            text = result['candidates'][0]['content']['parts'][0]['text']
-            log_ai_response(text)
-            return text
-        else:
+        if not result.get('candidates'):
             log_error("No candidates in Gemini response", result)
             return None
+        
+        # A candidate that ran out of tokens (or was blocked) may carry no parts
+        candidate = result['candidates'][0]
+        finish_reason = candidate.get('finishReason')
+        parts = (candidate.get('content') or {}).get('parts')
+        if not parts:
+            log_error(f"Gemini returned no text (finishReason: {finish_reason})", result)
+            return None
+        if finish_reason == "MAX_TOKENS":
+            log_error("Gemini response cut off at maxOutputTokens")
+        
+        text = "".join(part.get('text', '') for part in parts)
+        log_ai_response(text)
+        return text
             
     except requests.exceptions.Timeout:
         log_error("Gemini API timeout")
@@ -947,270 +1629,535 @@ def call_gemini_api(prompt):
         log_error("Unexpected error in Gemini API call", e)
         return None
 
+def get_request_dates():
+    """Return (today, yesterday, tomorrow) as date strings from a single clock read"""
+    now = datetime.now()
+    return (now.strftime(DATE_FORMAT),
+            (now - ONE_DAY).strftime(DATE_FORMAT),
+            (now + ONE_DAY).strftime(DATE_FORMAT))
+
+# Relative day words the AI passes through from the user, as offsets from today
+DATE_WORD_OFFSETS = {
+    'today': 0, 'aaj': 0,
+    'yesterday': -1, 'kal': -1,
+    'tomorrow': 1,
+    'parso': -2,
+}
+DAYS_AGO_PATTERN = re.compile(r'(\d+)\s*days?\s*ago')
+DATE_INPUT_FORMATS = (DATE_FORMAT, "%d/%m/%Y", "%d-%m-%Y")
+
+@lru_cache(maxsize=1024)
 def parse_date_from_text(date_text, current_date):
     """Parse various date formats"""
     date_text_lower = date_text.lower().strip()
     
-    current_dt = datetime.strptime(current_date, "%Y-%m-%d")
-    
-    if date_text_lower in ['today', 'aaj']:
+    offset = DATE_WORD_OFFSETS.get(date_text_lower)
+    if offset == 0:
         return current_date
     
-    if date_text_lower in ['yesterday', 'kal']:
-        return (current_dt - timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    if date_text_lower in ['tomorrow']:
-        return (current_dt + timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    if date_text_lower in ['parso']:
-        return (current_dt - timedelta(days=2)).strftime("%Y-%m-%d")
+    if offset is None:
+        days_ago_match = DAYS_AGO_PATTERN.search(date_text_lower)
+        if days_ago_match:
+            offset = -int(days_ago_match.group(1))
     
-    days_ago_match = re.search(r'(\d+)\s*days?\s*ago', date_text_lower)
-    if days_ago_match:
-        days = int(days_ago_match.group(1))
-        return (current_dt - timedelta(days=days)).strftime("%Y-%m-%d")
-    
-    try:
-        parsed = datetime.strptime(date_text, "%Y-%m-%d")
-        return parsed.strftime("%Y-%m-%d")
-    except:
-        pass
+    if offset is not None:
+        current_dt = datetime.strptime(current_date, DATE_FORMAT)
+        return (current_dt + timedelta(days=offset)).strftime(DATE_FORMAT)
     
-    try:
-        parsed = datetime.strptime(date_text, "%d/%m/%Y")
-        return parsed.strftime("%Y-%m-%d")
-    except:
-        pass
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(date_text, fmt).strftime(DATE_FORMAT)
+        except ValueError:
+            pass
     
     return current_date
 
-def execute_ai_actions(phone, actions_json):
+# Functions the AI is allowed to call, keyed by the name used in its JSON
+AI_FUNCTIONS = {fn.__name__: fn for fn in (
+    add_income_db,
+    add_expense_db,
+    update_transaction_db,
+    delete_transaction_db,
+    update_user_name_db,
+    view_transactions_db,
+    get_summary_db,
+    request_data_deletion,
+    predict_recurring_expenses_db,
+    add_loan_db,
+    calculate_loan_interest,
+)}
+# Parameter names each function accepts; anything else the AI adds is dropped
+AI_FUNCTION_PARAMS = {name: frozenset(inspect.signature(fn).parameters) for name, fn in AI_FUNCTIONS.items()}
+
+def execute_ai_actions(phone, actions_json, current_date=None):
     """Execute actions from AI response"""
     results = []
-    current_date = datetime.now().strftime("%Y-%m-%d")
+    if current_date is None:
+        current_date = datetime.now().strftime(DATE_FORMAT)
     
-    for action in actions_json.get("actions", []):
-        function_name = action.get("function")
-        params = action.get("params", {})
-        
-        params["phone"] = phone
-        
-        if "date" in params:
-            params["date"] = parse_date_from_text(params["date"], current_date)
-        
-        if "amount" in params:
-            try:
-                amount_str = str(params["amount"]).lower().replace(',', '')
-                if 'k' in amount_str:
-                    amount_str = amount_str.replace('k', '')
-                    params["amount"] = float(amount_str) * 1000
-                elif 'lakh' in amount_str:
-                    amount_str = amount_str.replace('lakh', '').strip()
-                    params["amount"] = float(amount_str) * 100000
-                else:
-                    params["amount"] = float(amount_str)
-            except ValueError:
-                params["amount"] = 0
-        
-        try:
-            if function_name == "add_income_db":
-                result = add_income_db(**params)
-            elif function_name == "add_expense_db":
-                result = add_expense_db(**params)
-            elif function_name == "update_transaction_db":
-                result = update_transaction_db(**params)
-            elif function_name == "delete_transaction_db":
-                result = delete_transaction_db(**params)
-            elif function_name == "update_user_name_db":
-                result = update_user_name_db(**params)
-            elif function_name == "view_transactions_db":
-                result = view_transactions_db(**params)
-            elif function_name == "get_summary_db":
-                result = get_summary_db(**params)
-            elif function_name == "request_data_deletion":
-                result = request_data_deletion(**params)
-            # NEW: Planning & Prediction
-            elif function_name == "predict_recurring_expenses_db":
-                result = predict_recurring_expenses_db(**params)
-            # NEW: Loan management
-            elif function_name == "add_loan_db":
-                result = add_loan_db(**params)
-            # NEW: Interest Calculation
-            elif function_name == "calculate_loan_interest":
-                result = calculate_loan_interest(**params)
-            else:
-                result = {"status": "error", "message": f"Unknown function: {function_name}"}
-            
-            results.append(result)
-        except TypeError as e:
-            error_msg = f"Invalid parameters for {function_name}: {str(e)}"
-            log_error(error_msg, e)
-            results.append({"status": "error", "message": error_msg})
-        except Exception as e:
-            error_msg = f"Error executing {function_name}: {str(e)}"
-            log_error(error_msg, e)
-            results.append({"status": "error", "message": error_msg})
+    actions = actions_json.get("actions", [])
+    # One commit for every write in the message instead of one per action
+    writes = any(action.get("function") not in READ_ONLY_FUNCTIONS for action in actions)
+    with transaction(phone) if writes else nullcontext():
+        for action in actions:
+            results.append(execute_ai_action(phone, action, current_date))
     
     return results
 
+# "5000", "5,000", "5k", "1.5 lakh", "8.5%"
+AMOUNT_PATTERN = re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+))\s*(k|lakhs?|%)?\s*', re.IGNORECASE)
+AMOUNT_MULTIPLIERS = {None: 1, 'k': 1000, 'lakh': 100000, 'lakhs': 100000, '%': 1}
+# Other numeric params; the loans table is STRICT, so text like "8.5%" would
+# be rejected on insert
+NUMERIC_PARAMS = ("interest_rate", "emi_amount", "tenure_years")
+
+def parse_number(value):
+    """Convert an AI-supplied number to a float, or None if it is missing or unreadable"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        return None
+    
+    match = AMOUNT_PATTERN.fullmatch(str(value).replace(',', ''))
+    if not match:
+        return None
+    unit = match.group(2)
+    return float(match.group(1)) * AMOUNT_MULTIPLIERS[unit and unit.lower()]
+
+def parse_amount(amount):
+    """Convert an AI-supplied amount to a float, or 0 if it cannot be read"""
+    number = parse_number(amount)
+    return 0 if number is None else number
+
+def execute_ai_action(phone, action, current_date):
+    """Run a single AI action and return its result"""
+    function_name = action.get("function")
+    handler = AI_FUNCTIONS.get(function_name)
+    if handler is None:
+        return {"status": "error", "message": f"Unknown function: {function_name}"}
+    
+    allowed = AI_FUNCTION_PARAMS[function_name]
+    params = {key: value for key, value in (action.get("params") or {}).items() if key in allowed}
+    params["phone"] = phone
+    
+    if "date" in params:
+        params["date"] = parse_date_from_text(params["date"], current_date)
+    
+    if "amount" in params:
+        params["amount"] = parse_amount(params["amount"])
+    for key in NUMERIC_PARAMS:
+        if key in params:
+            params[key] = parse_number(params[key])
+    
+    try:
+        return handler(**params)
+    except TypeError as e:
+        error_msg = f"Invalid parameters for {function_name}: {str(e)}"
+        log_error(error_msg, e)
+        return {"status": "error", "message": error_msg}
+    except Exception as e:
+        error_msg = f"Error executing {function_name}: {str(e)}"
+        log_error(error_msg, e)
+        return {"status": "error", "message": error_msg}
+
 def format_transaction_results(results):
     """Format transaction results for display"""
-    formatted_text = ""
+    parts = []
     
     for result in results:
         if isinstance(result, dict):
             # Handle Deletion Request Message
             if "deletion_message" in result:
-                formatted_text += f"\n\n{result['deletion_message']}\n"
+                parts.append(f"\n\n{result['deletion_message']}\n")
 
             # NEW: Handle Prediction Report
             if "prediction_report" in result:
-                formatted_text += f"\n\n{result['prediction_report']}\n"
+                parts.append(f"\n\n{result['prediction_report']}\n")
             
             # NEW: Handle Loan Addition
             if "loan_id" in result:
-                formatted_text += f"\n\n✅ {result['message']} (ID: {result['loan_id']})\n"
+                parts.append(f"\n\n✅ {result['message']} (ID: {result['loan_id']})\n")
             
             # NEW: Handle Interest Calculation
             if "interest_analysis" in result:
-                 formatted_text += f"\n\n🧮 {result['interest_analysis']}\n"
+                parts.append(f"\n\n🧮 {result['interest_analysis']}\n")
 
             if "income" in result or "expense" in result:
                 for trans_type in ["income", "expense"]:
                     transactions = result.get(trans_type, [])
                     if transactions:
-                        formatted_text += f"\n\n*{trans_type.title()} Transactions:*\n"
+                        parts.append(f"\n\n*{trans_type.title()} Transactions:*\n")
                         for trans in transactions[:10]:
-                            formatted_text += f"• ID {trans['id']}: {trans['date']} | Rs{trans['amount']:.2f}\n"
-                            formatted_text += f"  {trans['category']} - {trans['description']}\n"
+                            parts.append(f"• ID {trans['id']}: {trans['date']} | Rs{trans['amount']:.2f}\n"
+                                         f"  {trans['category']} - {trans['description']}\n")
             
             elif "total_income" in result:
-                formatted_text += f"\n\n📊 *Financial Summary*\n"
-                formatted_text += f"Period: {result['period']}\n"
-                formatted_text += f"{'─' * 40}\n"
-                formatted_text += f"💰 Total Income: Rs{result['total_income']:,.2f} ({result['income_count']} transactions)\n"
-                formatted_text += f"💸 Total Expense: Rs{result['total_expense']:,.2f} ({result['expense_count']} transactions)\n"
-                formatted_text += f"{'─' * 40}\n"
-                formatted_text += f"💵 Balance: Rs{result['balance']:,.2f}\n"
+                parts.append(f"\n\n📊 *Financial Summary*\n"
+                             f"Period: {result['period']}\n"
+                             f"{'─' * 40}\n"
+                             f"💰 Total Income: Rs{result['total_income']:,.2f} ({result['income_count']} transactions)\n"
+                             f"💸 Total Expense: Rs{result['total_expense']:,.2f} ({result['expense_count']} transactions)\n"
+                             f"{'─' * 40}\n"
+                             f"💵 Balance: Rs{result['balance']:,.2f}\n")
                 
                 if result.get('category_expenses'):
-                    formatted_text += f"\n*Top Expense Categories:*\n"
+                    parts.append("\n*Top Expense Categories:*\n")
                     for i, (cat, data) in enumerate(list(result['category_expenses'].items())[:5], 1):
-                        formatted_text += f"{i}. {cat}: Rs{data['amount']:,.2f} ({data['count']} transactions)\n"
+                        parts.append(f"{i}. {cat}: Rs{data['amount']:,.2f} ({data['count']} transactions)\n")
                 
                 if result.get('category_income'):
-                    formatted_text += f"\n*Income Sources:*\n"
+                    parts.append("\n*Income Sources:*\n")
                     for i, (cat, data) in enumerate(list(result['category_income'].items())[:5], 1):
-                        formatted_text += f"{i}. {cat}: Rs{data['amount']:,.2f} ({data['count']} transactions)\n"
-    
-    return formatted_text
-
-def get_ai_response(phone, user_message):
+                        parts.append(f"{i}. {cat}: Rs{data['amount']:,.2f} ({data['count']} transactions)\n")
+    
+    return "".join(parts)
+
+# Characters that glue onto the one before them (ZWJ, variation selectors,
+# keycap, emoji skin tones), so a cut must not land right before them
+JOINING_CHARS = frozenset("\u200d\ufe0e\ufe0f\u20e3" + "".join(map(chr, range(0x1F3FB, 0x1F400))))
+# A flag is a pair of these, e.g. 🇮🇳 is U+1F1EE U+1F1F3
+REGIONAL_INDICATORS = frozenset(map(chr, range(0x1F1E6, 0x1F200)))
+
+def truncate_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Shorten text to fit a message without splitting an emoji or accented letter"""
+    if len(text) <= limit:
+        return text
+    
+    cut = limit - 3
+    # Marks cover combining accents and Devanagari vowel signs like the ी in की
+    while cut > 0 and (text[cut] in JOINING_CHARS or text[cut - 1] == "\u200d"
+                       or unicodedata.category(text[cut]).startswith("M")):
+        cut -= 1
+    
+    # Inside a run of flags, an odd number of indicators before the cut means
+    # it falls between the two halves of one
+    if text[cut] in REGIONAL_INDICATORS:
+        run = 0
+        while run < cut and text[cut - run - 1] in REGIONAL_INDICATORS:
+            run += 1
+        if run % 2:
+            cut -= 1
+    return text[:cut] + "..."
+
+JSON_DECODER = json.JSONDecoder()
+
+def extract_json(text):
+    """Decode the first JSON object in text, skipping code fences or prose around it"""
+    start = text.find('{')
+    # Usual case: one object, possibly fenced, so it spans first '{' to last '}'
+    if start != -1:
+        try:
+            obj = parse_json(text[start:text.rfind('}') + 1])
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            pass
+    while start != -1:
+        try:
+            obj, _ = JSON_DECODER.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        start = text.find('{', start + 1)
+    return None
+
+def get_ai_response(phone, user_message, user_name="User"):
     """Get AI response using Gemini API (Text Only)"""
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    history = get_chat_history(phone, limit=20)
-    context = "\n".join([f"{role}: {msg}" for role, msg in history[-10:]])
-    
-    user_name = get_user_name(phone)
-    
-    system_prompt = get_system_prompt(current_date, yesterday, tomorrow, phone)
-    
-    full_prompt = system_prompt + """
-
-USER INFO:
-- Phone: """ + phone + """
-- Name: """ + user_name + """
-
-RECENT CHAT:
-""" + (context if context else "No previous conversation") + """
-
-USER MESSAGE: """ + user_message + """
-
-Analyze and respond in JSON format with actions and response_text."""
+    return get_ai_responses(phone, [user_message], user_name)[0]
+
+def get_ai_responses(phone, user_messages, user_name="User", dynamic_context=None):
+    """Answer one or more messages from phone with a single Gemini call"""
+    current_date, yesterday, tomorrow = get_request_dates()
+    count = len(user_messages)
+    
+    if dynamic_context is None and _context_executor is not None:
+        dynamic_future = _context_executor.submit(build_dynamic_context, current_date, yesterday, tomorrow, phone)
+    
+    # With a memo, older turns come from its relevant entries instead of raw
+    # rows, so the prompt stays the same size however long the chat gets
+    memo_entries = get_memo_entries(phone)
+    if memo_entries:
+        relevant = retrieve_memo_entries(memo_entries, " ".join(user_messages), MEMO_RETRIEVAL_K)
+        memo_context = "\n\nCONVERSATION MEMO:\n" + format_memo_entries(relevant)
+        recent_history = get_chat_history(phone, limit=MEMO_RECENT_MESSAGES)
+    else:
+        memo_context = ""
+        recent_history = get_chat_history(phone, limit=10)
+    context = "\n".join([f"{role}: {msg}" for role, msg in recent_history])
+    
+    if dynamic_context is None:
+        if _context_executor is not None:
+            dynamic_context = dynamic_future.result()
+        else:
+            dynamic_context = build_dynamic_context(current_date, yesterday, tomorrow, phone)
     
-    ai_response = call_gemini_api(full_prompt)
+    turn = {
+        "memo_context": memo_context,
+        "context": context if context else "No previous conversation",
+    }
+    if count == 1:
+        turn["user_message"] = user_messages[0]
+        turn_template = USER_TURN_TEMPLATE
+    else:
+        turn["count"] = count
+        turn["user_message"] = "\n".join(f"{i}) {msg}" for i, msg in enumerate(user_messages, 1))
+        turn_template = BATCH_USER_TURN_TEMPLATE
+    
+    # Most stable first: instructions and user info, then the date/balances
+    # context, then memo, chat and the message itself
+    full_prompt = build_prompt_prefix(phone, user_name) + dynamic_context + turn_template.format_map(turn)
+    
+    # A burst of messages is a one-off combination, so only single ones are cached
+    if count == 1:
+        cache_key = make_response_cache_key(phone, user_messages[0], dynamic_context)
+    else:
+        cache_key = None
+    
+    ai_response = get_cached_response(cache_key)
+    if ai_response:
+        log_info("Response Cache", "Hit")
+    else:
+        # Each message in a burst needs its own share of the output budget
+        ai_response = call_gemini_api(full_prompt, GEMINI_REPLY_MAX_TOKENS * count)
     
     if not ai_response:
+        # Retrying each message would only wait on the same failing API again
         log_error("No response from Gemini API")
-        return "Sorry, I'm having trouble connecting right now. Please try again."
+        return ["Sorry, I'm having trouble connecting right now. Please try again."] * count
+    
+    if count > 1:
+        replies = parse_batched_replies(ai_response, count)
+        if replies is None:
+            # Nothing has run yet, so answering each message on its own is safe
+            log_error("Batched response unusable, answering messages one by one")
+            return [get_ai_response(phone, msg, user_name) for msg in user_messages]
     
     try:
-        ai_response = ai_response.strip()
-        
-        if ai_response.startswith("```json"):
-            ai_response = ai_response[7:]
-        elif ai_response.startswith("```"):
-            ai_response = ai_response[3:]
-        
-        if ai_response.endswith("```"):
-            ai_response = ai_response[:-3]
-        
-        ai_response = ai_response.strip()
-        
-        json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
-        if json_match:
-            ai_response = json_match.group(0)
-        
-        actions_json = json.loads(ai_response)
-        log_parsed_actions(actions_json)
-        
-        results = execute_ai_actions(phone, actions_json)
-        
-        response_text = actions_json.get("response_text", "Done!")
-        
-        formatted_results = format_transaction_results(results)
-        if formatted_results:
-            response_text += formatted_results
+        if count == 1:
+            actions_json = extract_json(ai_response)
+            if actions_json is None:
+                raise json.JSONDecodeError("No JSON object found", ai_response, 0)
+            log_parsed_actions(actions_json)
+            store_cached_response(cache_key, ai_response, actions_json)
+            replies = [actions_json]
         
-        errors = [r.get("message") for r in results if isinstance(r, dict) and r.get("status") == "error"]
-        if errors:
-            response_text += "\n\n⚠️ *Some issues:*\n" + "\n".join(f"• {err}" for err in errors)
-        
-        # Ensure response does not exceed 1600 characters
-        if len(response_text) > 1600:
-            response_text = response_text[:1597] + "..."
-
-        log_final_response(response_text)
-        return response_text
+        return [finish_ai_reply(phone, reply, current_date) for reply in replies]
         
     except json.JSONDecodeError as e:
         log_error("JSON parsing failed", e)
         log_info("Raw AI Response", ai_response)
         
-        return ("I understood what you said, but I'm having trouble formatting my response. "
-                "Could you try rephrasing that?")
+        return ["I understood what you said, but I'm having trouble formatting my response. "
+                "Could you try rephrasing that?"]
     
     except Exception as e:
         log_error("Unexpected error in AI response processing", e)
-        return "Oops! Something went wrong. Please try again."
-
-# ===========================
-# WHATSAPP WEBHOOK
-# ===========================
+        return ["Oops! Something went wrong. Please try again."] * count
+
+def parse_batched_replies(ai_response, count):
+    """Get the count per-message replies of a batched response, or None if it has no usable set"""
+    parsed = extract_json(ai_response) if ai_response else None
+    replies = parsed.get("replies") if parsed else None
+    if (not isinstance(replies, list) or len(replies) != count
+            or not all(isinstance(reply, dict) for reply in replies)):
+        return None
+    log_parsed_actions(parsed)
+    return replies
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Handle incoming WhatsApp messages"""
-    incoming_msg = request.values.get('Body', '').strip()
-    from_number = request.values.get('From', '').replace('whatsapp:', '').replace('+', '')
+def finish_ai_reply(phone, actions_json, current_date):
+    """Run the actions of one parsed reply and build the text sent back"""
+    results = execute_ai_actions(phone, actions_json, current_date)
     
-    log_user_input(from_number, incoming_msg)
+    parts = [actions_json.get("response_text", "Done!"), format_transaction_results(results)]
     
-    resp = MessagingResponse()
-    msg = resp.message()
+    errors = [r.get("message") for r in results if isinstance(r, dict) and r.get("status") == "error"]
+    if errors:
+        parts.append("\n\n⚠️ *Some issues:*\n")
+        parts.append("\n".join(f"• {err}" for err in errors))
+    response_text = truncate_message("".join(parts))
     
-    init_users_db()
+    log_final_response(response_text)
+    return response_text
+
+_message_batches = {}
+_message_batches_lock = threading.Lock()
+
+def get_batched_ai_response(phone, user_message, user_name="User"):
+    """Answer user_message together with any others phone sends within MESSAGE_BATCH_WINDOW.
+
+    The first message of a burst waits out the window and then answers the
+    whole batch with one Gemini call; later ones wait for their share.
+    """
+    if MESSAGE_BATCH_WINDOW <= 0:
+        return get_ai_response(phone, user_message, user_name)
     
-    user = check_user_exists(from_number)
+    future = Future()
+    with _message_batches_lock:
+        batch = _message_batches.get(phone)
+        leader = batch is None
+        if leader:
+            batch = _message_batches[phone] = []
+        batch.append((user_message, future))
     
-    if not user:
-        create_new_user(from_number)
-        log_info("New User", f"Created user {from_number}")
+    if not leader:
+        return future.result()
+    
+    try:
+        # A message the response cache can already answer gains nothing from
+        # waiting for others; the context is built once either way
+        dynamic_context = build_dynamic_context(*get_request_dates(), phone)
+        if not has_cached_response(make_response_cache_key(phone, user_message, dynamic_context)):
+            time.sleep(MESSAGE_BATCH_WINDOW)
+        with _message_batches_lock:
+            _message_batches.pop(phone)
+        if len(batch) > 1:
+            log_info("Message Batch", f"Answering {len(batch)} messages with one call")
         
-        privacy_msg = """🔐 *Welcome to Finance Manager Bot!*
+        replies = get_ai_responses(phone, [msg for msg, _ in batch], user_name, dynamic_context)
+        for (_, waiter), reply in zip(batch, replies):
+            waiter.set_result(reply)
+    except BaseException as e:
+        with _message_batches_lock:
+            if _message_batches.get(phone) is batch:
+                del _message_batches[phone]
+        for _, waiter in batch:
+            if not waiter.done():
+                waiter.set_exception(e)
+        raise
+    return future.result()
+
+# ===========================
+# CONVERSATION MEMO
+# ===========================
+# Memorization runs on its own thread because it waits on Gemini; retrieval
+# is a cheap keyword-overlap ranking done while building the prompt.
+
+MEMO_WRITER_PROMPT = """You maintain a compact memo of a user's conversation with a finance bot.
+Merge the NEW MESSAGES into the CURRENT MEMO. Keep facts that matter for future
+conversations: goals, plans, people, recurring payments, preferences, open questions.
+Drop small talk and anything already stored as a transaction. Merge entries on the
+same topic and keep at most """ + str(MEMO_MAX_ENTRIES) + """ entries.
+
+RESPOND IN JSON ONLY:
+{"entries": [{"topic": "short topic", "date": "YYYY-MM-DD", "summary": "one or two sentences"}]}
+"""
+
+MEMO_TOKEN_PATTERN = re.compile(r'\w+')
+
+def get_memo_entries(phone):
+    """Get the user's memo entries (empty list if no memo yet)"""
+    conn = get_user_db(phone)
+    c = conn.cursor()
+    c.execute("SELECT entries FROM memo WHERE id = 1")
+    row = c.fetchone()
+    return parse_json(row[0]) if row else []
+
+def retrieve_memo_entries(entries, message, k):
+    """Rank memo entries by IDF-weighted word overlap with message, newest first on ties"""
+    entry_tokens = [
+        set(MEMO_TOKEN_PATTERN.findall(f"{e.get('topic', '')} {e.get('summary', '')}".lower()))
+        for e in entries
+    ]
+    doc_freq = {}
+    for tokens in entry_tokens:
+        for token in tokens:
+            doc_freq[token] = doc_freq.get(token, 0) + 1
+    
+    query = set(MEMO_TOKEN_PATTERN.findall(message.lower()))
+    n = len(entries)
+    scored = []
+    for index, tokens in enumerate(entry_tokens):
+        score = sum(math.log((n + 1) / (doc_freq[t] + 1)) + 1 for t in query & tokens)
+        scored.append((score, index))
+    
+    # Entries are stored oldest first, so a higher index is more recent
+    top = sorted(scored, reverse=True)[:k]
+    return [entries[index] for _, index in sorted(top, key=lambda x: x[1])]
+
+def format_memo_entries(entries):
+    """Format memo entries for the prompt"""
+    return "\n".join(
+        f"- [{e.get('date', '')}] {e.get('topic', '')}: {e.get('summary', '')}" for e in entries
+    )
+
+def update_memo(phone):
+    """Fold chat messages newer than the memo into it once MEMO_UPDATE_INTERVAL have piled up"""
+    conn = get_user_db(phone)
+    c = conn.cursor()
+    c.execute("SELECT entries, last_chat_id, attempted_chat_id FROM memo WHERE id = 1")
+    row = c.fetchone()
+    entries, last_chat_id, attempted_chat_id = (parse_json(row[0]), row[1], row[2]) if row else ([], 0, 0)
+    
+    c.execute("SELECT id, role, message FROM chat_history WHERE id > ? ORDER BY id", (last_chat_id,))
+    new_rows = c.fetchall()
+    # After a failed attempt, wait for another MEMO_UPDATE_INTERVAL messages
+    # instead of calling Gemini again on every one
+    if sum(1 for row in new_rows if row[0] > attempted_chat_id) < MEMO_UPDATE_INTERVAL:
+        return
+    last_new_id = new_rows[-1][0]
+    
+    prompt = (MEMO_WRITER_PROMPT
+              + "\nTODAY: " + datetime.now().strftime(DATE_FORMAT)
+              + "\n\nCURRENT MEMO:\n" + json.dumps({"entries": entries}, ensure_ascii=False)
+              + "\n\nNEW MESSAGES:\n" + "\n".join(f"{role}: {msg}" for _, role, msg in new_rows))
+    
+    ai_response = call_gemini_api(prompt, GEMINI_MEMO_MAX_TOKENS)
+    parsed = extract_json(ai_response) if ai_response else None
+    new_entries = parsed.get("entries") if parsed else None
+    if not isinstance(new_entries, list):
+        log_error("Memo update returned no entries")
+        with conn:
+            conn.execute("INSERT INTO memo (id, entries, last_chat_id, attempted_chat_id) VALUES (1, '[]', 0, ?)"
+                         " ON CONFLICT (id) DO UPDATE SET attempted_chat_id = excluded.attempted_chat_id",
+                         (last_new_id,))
+        return
+    
+    new_entries = [e for e in new_entries if isinstance(e, dict)][-MEMO_MAX_ENTRIES:]
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO memo (id, entries, last_chat_id, attempted_chat_id) VALUES (1, ?, ?, ?)",
+                     (json.dumps(new_entries, ensure_ascii=False), last_new_id, last_new_id))
+
+_memo_pending = set()
+_memo_pending_lock = threading.Lock()
+
+def schedule_memo_update(phone):
+    """Queue a memo check for phone unless one is already waiting"""
+    with _memo_pending_lock:
+        if phone in _memo_pending:
+            return
+        _memo_pending.add(phone)
+    _memo_queue.put(phone)
+
+def _memo_loop(memo_queue):
+    """Run queued memo updates one at a time"""
+    while True:
+        phone = memo_queue.get()
+        with _memo_pending_lock:
+            _memo_pending.discard(phone)
+        try:
+            update_memo(phone)
+        except Exception as e:
+            log_error(f"Memo update failed for {phone}", e)
+
+def start_memo_worker():
+    """Start the memo thread with a fresh queue"""
+    global _memo_queue, _memo_pending_lock
+    _memo_queue = queue.Queue()
+    _memo_pending_lock = threading.Lock()
+    _memo_pending.clear()
+    threading.Thread(target=_memo_loop, args=(_memo_queue,),
+                     name="memo-writer", daemon=True).start()
+
+start_memo_worker()
+os.register_at_fork(after_in_child=start_memo_worker)
+
+# ===========================
+# WHATSAPP WEBHOOK
+# ===========================
+
+# Onboarding replies are fixed text, so they live at module level
+PRIVACY_MSG = """🔐 *Welcome to Finance Manager Bot!*
 
 Before we begin, please read our privacy policy:
 
@@ -1226,22 +2173,8 @@ Before we begin, please read our privacy policy:
 
 Do you accept our privacy policy?
 Reply *YES* to continue or *NO* to decline."""
-        
-        msg.body(privacy_msg)
-        log_final_response(privacy_msg)
-        return str(resp)
-    
-    # Ensures database schema is up-to-date (creates 'loans' table if missing)
-    init_user_db(from_number)
 
-    privacy_status = get_privacy_status(from_number)
-    
-    if privacy_status == 'no':
-        if incoming_msg.lower() in ['yes', 'y', 'हां', 'ha', 'haan', 'accept']:
-            update_privacy_acceptance(from_number, 'yes')
-            log_info("Privacy", f"User {from_number} accepted privacy policy")
-            
-            welcome_msg = """✅ *Thank you for accepting!*
+WELCOME_MSG = """✅ *Thank you for accepting!*
 
 Welcome to your personal Finance Manager! 🎉
 
@@ -1255,31 +2188,58 @@ Welcome to your personal Finance Manager! 🎉
 🗑️ Delete entries: "Delete that chai expense"
 
 Just message me naturally in Hindi or English!"""
+
+DECLINE_MSG = "❌ *Privacy Policy Required*\n\nWe cannot provide our services without your consent.\n\nReply *YES* when ready to accept."
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Handle incoming WhatsApp messages"""
+    incoming_msg = request.values.get('Body', '').strip()
+    from_number = request.values.get('From', '').replace('whatsapp:', '').replace('+', '')
+    
+    log_user_input(from_number, incoming_msg)
+    
+    resp = MessagingResponse()
+    msg = resp.message()
+    
+    user = get_user_row(from_number)
+    
+    if not user:
+        create_new_user(from_number)
+        log_info("New User", f"Created user {from_number}")
+        
+        msg.body(PRIVACY_MSG)
+        log_final_response(PRIVACY_MSG)
+        return str(resp)
+    
+    privacy_status, user_name = user
+    
+    if privacy_status == 'no':
+        if incoming_msg.lower() in ['yes', 'y', 'हां', 'ha', 'haan', 'accept']:
+            update_privacy_acceptance(from_number, 'yes')
+            log_info("Privacy", f"User {from_number} accepted privacy policy")
             
-            msg.body(welcome_msg)
-            log_final_response(welcome_msg)
+            msg.body(WELCOME_MSG)
+            log_final_response(WELCOME_MSG)
         else:
-            decline_msg = "❌ *Privacy Policy Required*\n\nWe cannot provide our services without your consent.\n\nReply *YES* when ready to accept."
-            msg.body(decline_msg)
-            log_final_response(decline_msg)
+            msg.body(DECLINE_MSG)
+            log_final_response(DECLINE_MSG)
         
         return str(resp)
     
-    # Handle Chat History
-    add_to_chat_history(from_number, 'user', incoming_msg)
-    
     # Pass message only
-    ai_response = get_ai_response(from_number, incoming_msg)
+    ai_response = get_batched_ai_response(from_number, incoming_msg, user_name)
     
+    # Both turns are stored by the background writer after the reply goes out
+    add_to_chat_history(from_number, 'user', incoming_msg)
     add_to_chat_history(from_number, 'assistant', ai_response)
+    schedule_memo_update(from_number)
     
     msg.body(ai_response)
     return str(resp)
 
-@app.route('/')
-def home():
-    """Home page with status"""
-    status_html = """
+# Everything on the page is fixed at startup, so it is rendered once
+HOME_PAGE_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -1343,24 +2303,76 @@ def home():
     </body>
     </html>
     """
-    return status_html
 
-@app.route('/health', methods=['GET'])
+HOME_PAGE_BODY = HOME_PAGE_HTML.encode("utf-8")
+
+def home():
+    """Home page with status: (body, content type)"""
+    return HOME_PAGE_BODY, "text/html; charset=utf-8"
+
+# Only the cache stats change at runtime; the rest is fixed at startup
+HEALTH_STATUS = {
+    "status": "healthy",
+    "gemini_api": "configured" if GEMINI_API_KEY else "not_configured",
+    "max_chat_history": MAX_CHAT_HISTORY,
+    "logging_enabled": ENABLE_DETAILED_LOGGING
+}
+
+# (cache stats, serialized body) of the last health response
+_health_body = (None, b"")
+
+def health_body():
+    """Get the /health JSON, serializing again only when the cache stats moved"""
+    global _health_body
+    stats = (response_cache_stats["hits"], response_cache_stats["similar_hits"],
+             response_cache_stats["misses"], len(_response_cache))
+    cached_stats, body = _health_body
+    if cached_stats != stats:
+        cache = dict(zip(("hits", "similar_hits", "misses", "size"), stats))
+        body = json.dumps(dict(HEALTH_STATUS, response_cache=cache), separators=(",", ":")).encode("utf-8")
+        _health_body = (stats, body)
+    return body
+
 def health_check():
-    """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "gemini_api": "configured" if GEMINI_API_KEY else "not_configured",
-        "max_chat_history": MAX_CHAT_HISTORY,
-        "logging_enabled": ENABLE_DETAILED_LOGGING
-    }, 200
+    """Health check endpoint: (body, content type)"""
+    return health_body(), "application/json"
+
+# Uptime monitors and liveness probes poll these. They are served only here,
+# ahead of Flask, which skips its request context, routing and response object
+STATUS_ROUTES = {
+    "/": home,
+    "/health": health_check,
+}
+
+def serve_status_routes(wsgi_app):
+    """Wrap wsgi_app so GET/HEAD on STATUS_ROUTES are answered without reaching Flask"""
+    def middleware(environ, start_response):
+        route = STATUS_ROUTES.get(environ.get("PATH_INFO"))
+        if route is None:
+            return wsgi_app(environ, start_response)
+        method = environ.get("REQUEST_METHOD")
+        if method not in ("GET", "HEAD"):
+            start_response("405 Method Not Allowed", [("Allow", "GET, HEAD"), ("Content-Length", "0")])
+            return [b""]
+        body, content_type = route()
+        start_response("200 OK", [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+        return [b"" if method == "HEAD" else body]
+    return middleware
+
+app.wsgi_app = serve_status_routes(app.wsgi_app)
 
 # ===========================
 # MAIN
 # ===========================
 
+def init_databases():
+    """One-time startup work shared by the dev server and wsgi.py"""
+    with app.app_context():
+        init_users_db()
+    migrate_user_dbs_to_wal()
+
 if __name__ == '__main__':
-    init_users_db()
+    init_databases()
     
     print("\n" + "=" * 80)
     print("   🤖 WHATSAPP FINANCE MANAGER BOT")
@@ -1384,6 +2396,7 @@ if __name__ == '__main__':
     print("   • Set GEMINI_API_KEY environment variable")
     print("   • Configure Twilio webhook: http://your-server/webhook")
     print("   • For local: ngrok http 5000")
+    print("   • For production: gunicorn -c gunicorn.conf.py wsgi:app")
     
     print("\n🌐 Server starting on http://localhost:5000")
     print("=" * 80 + "\n")
@@ -1391,4 +2404,4 @@ if __name__ == '__main__':
     if not GEMINI_API_KEY:
         print("⚠️  WARNING: GEMINI_API_KEY not set!\n")
     
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    app.run(port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""Gunicorn settings for the Finance Manager Bot.
+
+Each webhook spends most of its time waiting on Gemini, so every worker
+runs a pool of threads to keep serving other users during that wait.
+Threads rather than gevent: the SQLite connection pool is per thread and
+sqlite3 calls would block a gevent hub.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+# Gemini calls time out after 60s; leave headroom for the DB work around them
+timeout = 90
+
+# Twilio and tunnels like ngrok reuse connections between webhooks; keep them
+# open past gunicorn's 2s default so each message skips a new TCP handshake
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Import app.py once in the master so compiled regexes and prompt constants
+# are shared copy-on-write with the workers
+preload_app = True
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("ENABLE_DETAILED_LOGGING", "false")
+os.environ.setdefault("MESSAGE_BATCH_WINDOW", "0")
+# app.py creates its databases relative to the working directory on import
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.prompts = []
+        self.call_gemini_api = app.call_gemini_api
+        app.call_gemini_api = self.fake_gemini
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        app.call_gemini_api = self.call_gemini_api
+
+    def fake_gemini(self, prompt, max_tokens=None):
+        self.prompts.append(prompt)
+        return json.dumps({"actions": [{"function": "get_summary_db", "params": {}}],
+                           "response_text": f"Summary #{len(self.prompts)}"})
+
+    def send(self, body, phone="whatsapp:+919000000001"):
+        response = self.client.post("/webhook", data={"Body": body, "From": phone})
+        self.assertEqual(response.status_code, 200)
+        app.flush_background_writes()
+        return response.get_data(as_text=True)
+
+    def test_exact_repeat_hits(self):
+        self.send("hi")
+        self.send("yes")
+        hits = app.response_cache_stats["hits"]
+
+        first = self.send("show my balance")
+        second = self.send("show my balance")
+
+        self.assertEqual(len(self.prompts), 1)
+        self.assertEqual(app.response_cache_stats["hits"], hits + 1)
+        self.assertIn("Summary #1", first)
+        self.assertIn("Summary #1", second)
+
+    def test_key_ignores_case_and_spacing(self):
+        key = app.make_response_cache_key("911", "Show my  balance", "ctx")
+        self.assertEqual(key, app.make_response_cache_key("911", "show my balance ", "ctx"))
+        self.assertNotEqual(key[0], app.make_response_cache_key("911", "show my balance", "ctx2")[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,7 @@
+"""WSGI entry point for production servers.
+
+Run with: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import app, init_databases
+
+init_databases()